@@ -14,9 +14,9 @@ from aps.libs import Register
 AsrAtt = Register("asr_att")
 
 
-def padding_mask(vec: th.Tensor) -> th.Tensor:
+def padding_mask(vec: th.Tensor, max_len: Optional[int] = None) -> th.Tensor:
     """
-    Generate padding masks
+    Generate padding masks (bool tensor, true for the padding positions)
 
     In [1]: a = th.tensor([5, 3, 2, 6, 1])
     In [2]: padding_mask(a)
@@ -26,13 +26,18 @@ def padding_mask(vec: th.Tensor) -> th.Tensor:
             [False, False,  True,  True,  True,  True],
             [False, False, False, False, False, False],
             [False,  True,  True,  True,  True,  True]])
+    Args:
+        vec (Tensor): N, lengths
+        max_len (int or None): width of the mask, use max(vec) if None
+    Return:
+        mask (Tensor): N x max_len
     """
-    N = vec.shape[-1]
     # vector may not in sorted order
-    M = vec.max().item()
-    templ = th.arange(M, device=vec.device).repeat([N, 1])
-    mask = (templ >= vec.unsqueeze(1))
-    return mask
+    if max_len is None:
+        max_len = int(vec.max().item())
+    # 1 x T >= N x 1 => N x T (broadcast, no repeat)
+    templ = th.arange(max_len, device=vec.device)
+    return templ[None, :] >= vec[:, None]
 
 
 def att_instance(att_type: str, enc_dim: int, dec_dim: int,
@@ -10,7 +10,7 @@ import torch.nn.functional as tf
 from typing import Optional, Tuple, Union, List, Dict
 
 from aps.asr.base.layer import VariantRNN, FSMN, Conv1d, Conv2d, PyTorchRNN
-from aps.asr.base.layer import rnn_output_nonlinear
+from aps.asr.base.layer import rnn_output_nonlinear, check_tensor_core_dims
 from aps.asr.base.jit import LSTM
 from aps.libs import Register
 
@@ -106,11 +106,17 @@ class PyTorchRNNEncoder(EncoderBase):
                  hidden: int = 512,
                  dropout: int = 0.2,
                  bidirectional: bool = False,
-                 non_linear: str = "none"):
+                 non_linear: str = "none",
+                 autocast: bool = False):
         super(PyTorchRNNEncoder, self).__init__(inp_features, out_features)
         if non_linear not in rnn_output_nonlinear:
             raise ValueError(
                 f"Unsupported output non-linear function: {non_linear}")
+        if autocast:
+            check_tensor_core_dims(
+                inp_features if input_project is None else input_project,
+                hidden)
+        self.autocast = autocast
         if input_project:
             self.proj = nn.Linear(inp_features, input_project)
         else:
@@ -127,8 +133,23 @@ class PyTorchRNNEncoder(EncoderBase):
         self.non_linear = rnn_output_nonlinear[non_linear]
 
     def flat(self):
+        """
+        Compact the RNN weights into one contiguous chunk. The forward never
+        calls it: it's done by nn.RNNBase when moving the module to device,
+        so only call it when the weights are re-allocated outside (e.g.,
+        after wrapped by DDP or reassigned manually)
+        """
         self.rnns.flatten_parameters()
 
+    @th.jit.unused
+    def autocast_rnns(self, inp: th.Tensor) -> th.Tensor:
+        """
+        Run RNNs in FP16 (tensor cores) while the output layer stays in FP32
+        """
+        with th.autocast("cuda"):
+            out, _ = self.rnns(inp)
+        return out.float()
+
     def forward(self,
                 inp: th.Tensor,
                 inp_len: Optional[th.Tensor],
@@ -143,7 +164,10 @@ class PyTorchRNNEncoder(EncoderBase):
         """
         if self.proj is not None:
             inp = tf.relu(self.proj(inp))
-        out, _ = self.rnns(inp)
+        if self.autocast:
+            out = self.autocast_rnns(inp)
+        else:
+            out, _ = self.rnns(inp)
         # out = var_len_rnn_forward(self.rnns,
         #                           inp,
         #                           inp_len=inp_len,
@@ -238,7 +262,8 @@ class VariantRNNEncoder(EncoderBase):
                  non_linear: str = "tanh",
                  norm: str = "",
                  pyramid_stack: bool = False,
-                 add_forward_backward: bool = False):
+                 add_forward_backward: bool = False,
+                 autocast: bool = False):
         super(VariantRNNEncoder, self).__init__(inp_features, out_features)
 
         def derive_inp_size(layer_idx: int) -> int:
@@ -278,20 +303,29 @@ class VariantRNNEncoder(EncoderBase):
                        dropout=derive_dropout(i),
                        bidirectional=bidirectional,
                        non_linear=non_linear if i != num_layers - 1 else "none",
-                       add_forward_backward=add_forward_backward)
-            for i in range(num_layers)
+                       add_forward_backward=add_forward_backward,
+                       autocast=autocast) for i in range(num_layers)
         ])
         self.pyramid_stack = pyramid_stack
 
+    def flat(self):
+        """
+        Compact the RNN weights of each layer (see PyTorchRNNEncoder.flat)
+        """
+        for layer in self.enc_layers:
+            layer.flat()
+
     def _subsample_concat(self, inp: th.Tensor,
                           inp_len: Optional[th.Tensor]) -> EncRetType:
         """
         Do subsampling for RNN output
         """
-        if inp.shape[1] % 2:
-            inp = inp[:, :-1]
-        # concat
-        inp = th.cat([inp[:, ::2], inp[:, 1::2]], -1)
+        N, T, F = inp.shape
+        T = T // 2
+        # concat the adjacent frames: N x T x F => N x T/2 x 2F, which is
+        # the same as th.cat([inp[:, ::2], inp[:, 1::2]], -1) but only
+        # needs (at most) one copy
+        inp = inp[:, :T * 2].reshape(N, T, 2 * F)
         return inp, None if inp_len is None else inp_len // 2
 
     def forward(self, inp: th.Tensor,
@@ -304,10 +338,14 @@ class VariantRNNEncoder(EncoderBase):
             out_pad (Tensor): (N) x To x F
             out_len (Tensor or None): (N) x To
         """
+        # keep a cpu copy of the lengths for packing in each layer, which
+        # avoids the device to host synchronization per layer
+        rnn_len = None if inp_len is None else inp_len.cpu()
         for i, layer in enumerate(self.enc_layers):
             if i != 0 and self.pyramid_stack:
                 inp, inp_len = self._subsample_concat(inp, inp_len)
-            inp = layer(inp, inp_len)
+                rnn_len = None if rnn_len is None else rnn_len // 2
+            inp = layer(inp, rnn_len)
         return inp, inp_len
 
 
@@ -330,7 +368,12 @@ class Conv1dEncoder(EncoderBase):
         super(Conv1dEncoder, self).__init__(inp_features, out_features)
 
         def int2list(param, repeat):
-            return [param] * repeat if isinstance(param, int) else param
+            if isinstance(param, int):
+                return [param] * repeat
+            if len(param) != repeat:
+                raise ValueError(f"Expect {repeat} values for the conv1d " +
+                                 f"parameters, but got {param}")
+            return param
 
         stride = int2list(stride, num_layers)
         dilation = int2list(dilation, num_layers)
@@ -455,6 +498,9 @@ class FSMNEncoder(EncoderBase):
         super(FSMNEncoder, self).__init__(inp_features, out_features)
         if isinstance(dilation, int):
             dilation = [dilation] * num_layers
+        if len(dilation) != num_layers:
+            raise ValueError(f"Expect {num_layers} values for dilation, " +
+                             f"but got {dilation}")
         self.enc_layers = nn.ModuleList([
             FSMN(inp_features if i == 0 else out_features,
                  out_features,
@@ -467,6 +513,14 @@ class FSMNEncoder(EncoderBase):
         ])
         self.residual = residual
 
+    @th.jit.unused
+    def fuse_for_inference(self) -> int:
+        """
+        Fold the BatchNorm of each FSMN layer into its output projection,
+        return number of the fused layers
+        """
+        return sum([fsmn.fuse_norm() for fsmn in self.enc_layers])
+
     def forward(self, inp: th.Tensor,
                 inp_len: Optional[th.Tensor]) -> EncRetType:
         """
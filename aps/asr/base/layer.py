@@ -3,14 +3,14 @@
 # Copyright 2020 Jian Wu
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
+import warnings
 import torch as th
 import torch.nn as nn
 import torch.nn.functional as tf
 
 from typing import Optional, Tuple, Union
-from torch.nn.utils.rnn import pad_packed_sequence, pack_padded_sequence
-
-from aps.const import TORCH_VERSION
+from torch.nn.utils.rnn import (pad_packed_sequence, pack_padded_sequence,
+                                PackedSequence)
 
 HiddenType = Union[th.Tensor, Tuple[th.Tensor, th.Tensor]]
 
@@ -22,37 +22,97 @@ rnn_output_nonlinear = {
 }
 
 
+@th.jit.unused
+def autocast_rnn_forward(
+    rnn_impl: nn.Module, inp: Union[th.Tensor, PackedSequence]
+) -> Union[th.Tensor, PackedSequence]:
+    """
+    Run RNN in FP16 (tensor cores), the caller casts the output back to FP32
+    """
+    with th.autocast("cuda"):
+        out, _ = rnn_impl(inp)
+    return out
+
+
 def var_len_rnn_forward(rnn_impl: nn.Module,
                         inp: th.Tensor,
                         inp_len: Optional[th.Tensor] = None,
                         enforce_sorted: bool = False,
-                        add_forward_backward: bool = False) -> th.Tensor:
+                        add_forward_backward: bool = False,
+                        autocast: bool = False) -> th.Tensor:
     """
     Forward of the RNN with variant length input
     Args:
         inp (Tensor): N x T x D
         inp_len (Tensor or None): N
+        autocast (bool): run RNN under th.autocast (FP16)
     Return:
         out (Tensor): N x T x H
     """
     if inp.dim() != 3:
         raise ValueError(
             f"RNN forward needs 3D tensor, got {inp.dim()} instead")
+    inv_perm = None
     if inp_len is not None:
-        inp = pack_padded_sequence(
-            inp,
-            inp_len if TORCH_VERSION < 1.7 else inp_len.tolist(),
-            batch_first=True,
-            enforce_sorted=enforce_sorted)
-    out, _ = rnn_impl(inp)
+        # pack_padded_sequence needs lengths on cpu, do the D2H copy only
+        # once (no-op if the caller already passes a cpu tensor)
+        inp_len = inp_len.cpu()
+        # sort by length explicitly (descending) so that the packed batch
+        # shrinks monotonically and enforce_sorted=True can be used
+        if not enforce_sorted:
+            inp_len, perm = inp_len.sort(descending=True)
+            inv_perm = perm.argsort().to(inp.device)
+            inp = inp[perm.to(inp.device)]
+        inp = pack_padded_sequence(inp,
+                                   inp_len,
+                                   batch_first=True,
+                                   enforce_sorted=True)
+    if autocast:
+        out = autocast_rnn_forward(rnn_impl, inp)
+    else:
+        out, _ = rnn_impl(inp)
     if inp_len is not None:
         out, _ = pad_packed_sequence(out, batch_first=True)
+        # restore the original order
+        if inv_perm is not None:
+            out = out[inv_perm]
+    # back to FP32 for the following layers
+    if autocast:
+        out = out.float()
     if add_forward_backward:
-        prev, last = th.chunk(out, 2, dim=-1)
-        out = prev + last
+        # bidirectional output is [forward, backward] on the last dim,
+        # N x T x 2H => N x T x 2 x H => N x T x H
+        out = out.view(out.shape[0], out.shape[1], 2, -1).sum(2)
     return out
 
 
+@th.jit.script
+def fsmn_memory_add(ctx: th.Tensor, memory: Optional[th.Tensor]) -> th.Tensor:
+    """
+    Add memory block of FSMN (scripted to fuse pointwise ops)
+    Args:
+        ctx (Tensor): N x P x T, output of the context convolution
+        memory (Tensor or None): N x T x P, memory block from previous layer
+    Return:
+        proj (Tensor): N x T x P, new memory block
+    """
+    # N x P x T => N x T x P
+    proj = ctx.transpose(1, 2)
+    if memory is not None:
+        proj = proj + memory
+    return proj
+
+
+def check_tensor_core_dims(input_size: int, hidden_size: int) -> None:
+    """
+    cuDNN RNNs use tensor cores (FP16) only if the sizes are multiples of 8
+    """
+    if input_size % 8 or hidden_size % 8:
+        warnings.warn(
+            "input_size/hidden_size of RNN should be multiples of 8 to " +
+            f"use tensor cores, got {input_size}/{hidden_size}")
+
+
 class OneHotEmbedding(nn.Module):
     """
     Onehot embedding layer
@@ -203,10 +263,16 @@ class Conv1d(nn.Module):
         # N x T x F => N x F x T
         inp = inp.transpose(1, 2)
         out = self.conv(inp)
-        # N x T x F
-        out = out.transpose(1, 2)
-        # norm & ReLU & dropout
-        out = self.drop(tf.relu(self.norm(out)))
+        if self.norm.name == "BN":
+            # apply BN on N x F x T directly to avoid a transpose pair
+            out = self.norm.norm(out)
+            # N x T x F
+            out = out.transpose(1, 2)
+        else:
+            # N x T x F
+            out = self.norm(out.transpose(1, 2))
+        # ReLU (in-place, on a fresh norm output) & dropout
+        out = self.drop(tf.relu(out, inplace=True))
         return out
 
 
@@ -252,13 +318,21 @@ class Conv2d(nn.Module):
             out (Tensor): N x C' x T' x F'
         """
         out = self.norm(self.conv(inp[:, None] if inp.dim() == 3 else inp))
-        return tf.relu(out)
+        return tf.relu(out, inplace=True)
 
 
 class FSMN(nn.Module):
     """
     Implement layer of feedforward sequential memory networks (FSMN)
+
+    NOTE: the residual connection of the context block (proj + conv(proj)) is
+          baked into the depthwise kernel by adding 1 to the tap aligned with
+          the current frame, which is equivalent as each filter only sees its
+          own channel (groups == proj_features)
     """
+    # version 2: identity folded into ctx_conv
+    # version 3: inp_proj changed to 1x1 conv1d
+    _version = 3
 
     def __init__(self,
                  inp_features: int,
@@ -270,7 +344,11 @@ class FSMN(nn.Module):
                  dilation: int = 0,
                  dropout: float = 0.0):
         super(FSMN, self).__init__()
-        self.inp_proj = nn.Linear(inp_features, proj_features, bias=False)
+        # 1x1 conv works on N x F x T directly (same as a linear layer)
+        self.inp_proj = nn.Conv1d(inp_features,
+                                  proj_features,
+                                  1,
+                                  bias=False)
         self.ctx_size = lctx + rctx + 1
         self.ctx_conv = nn.Sequential(
             nn.ConstantPad1d((lctx, rctx), 0.0),
@@ -281,6 +359,10 @@ class FSMN(nn.Module):
                       groups=proj_features,
                       padding=0,
                       bias=False))
+        # tap that aligns with the current frame (lctx zeros padded on left)
+        self.ctx_tap = lctx
+        with th.no_grad():
+            self.ctx_conv[1].weight[..., self.ctx_tap] += 1.0
         self.out_proj = nn.Linear(proj_features, out_features)
         self.out_drop = nn.Dropout(p=dropout)
         self.norm = Normalize1d(norm, out_features) if norm else None
@@ -297,25 +379,59 @@ class FSMN(nn.Module):
             out (Tensor): N x T x O, output of the layer
             proj (Tensor): N x T x P, new memory block
         """
-        # N x T x P
-        proj = self.inp_proj(inp[None, ...] if inp.dim() == 2 else inp)
-        # N x T x P => N x P x T => N x T x P
-        proj = proj.transpose(1, 2)
-        # add context
-        proj = proj + self.ctx_conv(proj)
-        proj = proj.transpose(1, 2)
-        # add memory block
-        if memory is not None:
-            proj = proj + memory
+        if inp.dim() == 2:
+            inp = inp[None, ...]
+        # N x T x F => N x F x T => N x P x T
+        proj = self.inp_proj(inp.transpose(1, 2))
+        # add context (residual included) & memory block, N x T x P
+        proj = fsmn_memory_add(self.ctx_conv(proj), memory)
         # N x T x O
         out = self.out_proj(proj)
         if self.norm is not None:
-            out = self.out_drop(tf.relu(self.norm(out)))
-        else:
-            out = self.out_drop(tf.relu(out))
+            out = self.norm(out)
+        # the output of linear/norm layers is not needed by their backward,
+        # so ReLU can be done in-place without extra allocation
+        out = self.out_drop(tf.relu(out, inplace=True))
         # N x T x O
         return out, proj
 
+    @th.jit.unused
+    def fuse_norm(self) -> bool:
+        """
+        Fold BatchNorm (inference mode) into out_proj, return true if fused
+        """
+        if self.norm is None or self.norm.name != "BN" or self.training:
+            return False
+        bn = self.norm.norm
+        # O
+        scale = bn.weight / th.sqrt(bn.running_var + bn.eps)
+        with th.no_grad():
+            self.out_proj.weight.mul_(scale[:, None])
+            self.out_proj.bias.copy_((self.out_proj.bias - bn.running_mean) *
+                                     scale + bn.bias)
+        self.norm = None
+        return True
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata,
+                              *args, **kwargs):
+        # a state dict without _metadata (e.g., built by hand) is taken as the
+        # current layout, as the folded identity can't be told from weights
+        version = local_metadata.get("version", self._version)
+        key = prefix + "ctx_conv.1.weight"
+        # checkpoints of version 1 use the explicit residual connection
+        if version < 2 and key in state_dict:
+            weight = state_dict[key].clone()
+            weight[..., self.ctx_tap] += 1.0
+            state_dict[key] = weight
+        key = prefix + "inp_proj.weight"
+        # checkpoints before version 3 use nn.Linear for inp_proj (checked on
+        # the layout of the weight as well)
+        if version < 3 and key in state_dict and state_dict[key].dim() == 2:
+            state_dict[key] = state_dict[key][..., None]
+        super(FSMN, self)._load_from_state_dict(state_dict, prefix,
+                                                local_metadata, *args,
+                                                **kwargs)
+
 
 class VariantRNN(nn.Module):
     """
@@ -331,10 +447,14 @@ class VariantRNN(nn.Module):
                  non_linear: str = "relu",
                  dropout: float = 0.0,
                  bidirectional: bool = False,
-                 add_forward_backward: bool = False):
+                 add_forward_backward: bool = False,
+                 autocast: bool = False):
         super(VariantRNN, self).__init__()
         if non_linear not in rnn_output_nonlinear:
             raise ValueError(f"Unsupported non_linear: {non_linear}")
+        if autocast:
+            check_tensor_core_dims(input_size, hidden_size)
+        self.autocast = autocast
         self.nonlinear = rnn_output_nonlinear[non_linear]
         self.rnn = PyTorchRNN(rnn,
                               input_size,
@@ -350,6 +470,9 @@ class VariantRNN(nn.Module):
             norm, project if project else hidden_size) if norm else None
         self.drop = nn.Dropout(dropout) if dropout != 0 else None
 
+    def flat(self):
+        self.rnn.flatten_parameters()
+
     def forward(self, inp: th.Tensor,
                 inp_len: Optional[th.Tensor]) -> th.Tensor:
         """
@@ -364,7 +487,8 @@ class VariantRNN(nn.Module):
             inp,
             inp_len=inp_len,
             enforce_sorted=False,
-            add_forward_backward=self.add_forward_backward)
+            add_forward_backward=self.add_forward_backward,
+            autocast=self.autocast)
         # proj
         if self.proj:
             out = self.proj(out)
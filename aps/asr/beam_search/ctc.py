@@ -3,6 +3,7 @@
 # Copyright 2020 Jian Wu
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
+import numpy as np
 import torch as th
 import torch.nn as nn
 
@@ -16,17 +17,17 @@ logger = get_logger(__name__)
 
 class PrefixScore(object):
     """
-    CTC prefix score used for beam search
+    CTC prefix score used for beam search (python floats, on host)
     """
 
-    def __init__(self, log_pb: th.Tensor, log_pn: th.Tensor) -> None:
+    def __init__(self, log_pb: float, log_pn: float) -> None:
         # score end with blank
         self.log_pb = log_pb
         # score end with non-blank
         self.log_pn = log_pn
 
-    def score(self) -> th.Tensor:
-        return th.logaddexp(self.log_pb, self.log_pn)
+    def score(self) -> float:
+        return np.logaddexp(self.log_pb, self.log_pn)
 
 
 def ctc_beam_search(ctc_prob: th.Tensor,
@@ -50,22 +51,24 @@ def ctc_beam_search(ctc_prob: th.Tensor,
     T, V = ctc_prob.shape
     logger.info(
         f"--- shape of the encoder output (CTC): {T} x {V}, blank = {blank}")
-    neg_inf = th.tensor(NEG_INF).to(ctc_prob.device)
-    zero = th.tensor(0.0).to(ctc_prob.device)
+    # the prefix search only needs the top-k of each frame, copy them to host
+    # once instead of doing .item() (a device sync) for each (t, n)
+    topk_score, topk_token = topk_score.tolist(), topk_token.tolist()
+    neg_inf, zero = NEG_INF, 0.0
     # (prefix, log_pb, log_pn)
     # NOTE: actually do not need sos/eos here, just place it in the sentence
     prev_beam = [(str(sos), PrefixScore(zero, neg_inf))]
     for t in range(T):
         next_beam = defaultdict(lambda: PrefixScore(neg_inf, neg_inf))
         for n in range(beam_size):
-            symb = topk_token[t, n].item()
-            logp = topk_score[t, n].item()
+            symb = topk_token[t][n]
+            logp = topk_score[t][n]
 
             for prefix, prev in prev_beam[:beam_size]:
                 # update log_pb only
                 if symb == blank:
                     other = next_beam[prefix]
-                    log_pb_update = th.logaddexp(prev.score() + logp,
+                    log_pb_update = np.logaddexp(prev.score() + logp,
                                                  other.log_pb)
                     next_beam[prefix] = PrefixScore(log_pb_update, other.log_pn)
                 else:
@@ -77,10 +80,10 @@ def ctc_beam_search(ctc_prob: th.Tensor,
                     other = next_beam[prefix_symb]
                     # repeat
                     if prefix_toks[-1] == symb:
-                        log_pn_update = th.logaddexp(prev.log_pb + logp,
+                        log_pn_update = np.logaddexp(prev.log_pb + logp,
                                                      other.log_pn)
                     else:
-                        log_pn_update = th.logaddexp(prev.score() + logp,
+                        log_pn_update = np.logaddexp(prev.score() + logp,
                                                      other.log_pn)
                     # update log_pn only
                     next_beam[prefix_symb] = PrefixScore(
@@ -88,7 +91,7 @@ def ctc_beam_search(ctc_prob: th.Tensor,
                     # repeat case
                     if prefix_toks[-1] == symb:
                         other = next_beam[prefix]
-                        log_pn_update = th.logaddexp(prev.log_pn + logp,
+                        log_pn_update = np.logaddexp(prev.log_pn + logp,
                                                      other.log_pn)
                         next_beam[prefix] = PrefixScore(other.log_pb,
                                                         log_pn_update)
@@ -98,7 +101,8 @@ def ctc_beam_search(ctc_prob: th.Tensor,
                            reverse=True)
     return [{
         "score":
-            score.score() / (1 if len_norm else len(prefix.split(",")) - 1),
+            float(score.score()) /
+            (1 if len_norm else len(prefix.split(",")) - 1),
         "trans":
             list(map(int, (prefix + f",{eos}").split(",")))
     } for prefix, score in prev_beam[:nbest]]
@@ -67,8 +67,11 @@ def rnnlm_score(rnnlm: nn.Module, back_point: th.Tensor, prev_token: th.Tensor,
     """
     # adjust order
     state = adjust_hidden(back_point, state)
-    # LM
-    lmout, state = rnnlm(prev_token[..., None], state)
+    # LM (use the incremental step if supported, e.g., transformer LM)
+    if hasattr(rnnlm, "step"):
+        lmout, state = rnnlm.step(prev_token[..., None], state)
+    else:
+        lmout, state = rnnlm(prev_token[..., None], state)
     # beam x V
     score = tf.log_softmax(lmout[:, -1], dim=-1)
     # return state & score
@@ -38,13 +38,16 @@ def greedy_search(decoder: nn.Module,
     dec_tok = [sos]
     pre_emb = None
     score = 0
+    # projected encoder output, computed once
+    memory_kv = decoder.memory_cache(enc_out)
     while True:
         pre_tok = th.tensor([dec_tok[-1]], device=device)
         # make one step
         dec_out, pre_emb = decoder.step(enc_out,
                                         pre_tok[:, None],
                                         out_idx=-1,
-                                        pre_emb=pre_emb)
+                                        pre_emb=pre_emb,
+                                        memory_kv=memory_kv)
         prob = tf.log_softmax(dec_out, dim=-1)
         pred_score, pred_token = th.topk(prob, 1, dim=-1)
         dec_tok.append(pred_token.item())
@@ -123,6 +126,11 @@ def beam_search(decoder: nn.Module,
     beam_tracker = BeamTracker(beam_param, ctc_prob=ctc_prob)
     pre_emb = None
     lm_state = None
+    # projected encoder output, computed once: T x beam x 2D
+    memory_kv = [
+        th.repeat_interleave(kv, beam_size, 1)
+        for kv in decoder.memory_cache(enc_out)
+    ]
     # T x 1 x D => T x beam x D
     enc_out = th.repeat_interleave(enc_out, beam_size, 1)
     # step by step
@@ -135,7 +143,8 @@ def beam_search(decoder: nn.Module,
             enc_out,
             pre_tok[:, None],
             out_idx=-1,
-            pre_emb=None if pre_emb is None else pre_emb[:, point])
+            pre_emb=None if pre_emb is None else pre_emb[:, point],
+            memory_kv=memory_kv)
 
         # compute prob: beam x V, nagetive
         am_prob = tf.log_softmax(dec_out / temperature, dim=-1)
@@ -201,6 +210,11 @@ def beam_search_batch(decoder: nn.Module,
     nbest = min(beam_size, nbest)
     device = enc_out.device
     enc_len = th.repeat_interleave(enc_len, beam_size, 0)
+    # projected encoder output, computed once: T x N*beam x 2D
+    memory_kv = [
+        th.repeat_interleave(kv, beam_size, 1)
+        for kv in decoder.memory_cache(enc_out)
+    ]
     # T x N x D => T x N*beam x D
     enc_out = th.repeat_interleave(enc_out, beam_size, 1)
 
@@ -233,7 +247,8 @@ def beam_search_batch(decoder: nn.Module,
             enc_out,
             pre_tok[:, None],
             out_idx=-1,
-            pre_emb=None if pre_emb is None else pre_emb[:, point])
+            pre_emb=None if pre_emb is None else pre_emb[:, point],
+            memory_kv=memory_kv)
         # compute prob: N*beam x V, nagetive
         am_prob = tf.log_softmax(dec_out / temperature, dim=-1)
 
@@ -12,6 +12,7 @@ from torch.nn.utils.rnn import pad_sequence
 
 from typing import Optional, Dict, Tuple, List
 from aps.asr.base.encoder import encoder_instance
+from aps.asr.base.encoder import PyTorchRNNEncoder, VariantRNNEncoder
 from aps.asr.xfmr.encoder import TransformerEncoder
 from aps.asr.beam_search.ctc import ctc_beam_search, ctc_viterbi_align
 from aps.libs import ApsRegisters
@@ -162,6 +163,42 @@ class CtcASR(ASREncoderBase):
         """
         return self._training_prep(x_pad, x_len)
 
+    def prepare_for_inference(self) -> bool:
+        """
+        Fuse the output layer of the encoder (if it's a linear layer without
+        following non-linear operations) into the CTC layer, so only one GEMM
+        is left per frame. Only used for inference (beam_search/ctc_align, the
+        network is switched to the evaluation mode), return true if fused
+        """
+        self.eval()
+        if not isinstance(self.ctc, nn.Linear):
+            return False
+        outp = None
+        if isinstance(self.encoder, PyTorchRNNEncoder):
+            if self.encoder.non_linear is None:
+                outp = self.encoder.outp
+                self.encoder.outp = nn.Identity()
+        elif isinstance(self.encoder, VariantRNNEncoder):
+            last = self.encoder.enc_layers[-1]
+            if last.proj is not None and all(
+                    m is None for m in [last.norm, last.nonlinear, last.drop]):
+                outp = last.proj
+                last.proj = None
+        if outp is None:
+            return False
+        fused = nn.Linear(outp.in_features,
+                          self.ctc.out_features).to(self.ctc.weight.device)
+        with th.no_grad():
+            # V x D @ D x H => V x H
+            fused.weight.copy_(self.ctc.weight @ outp.weight)
+            fused.bias.zero_()
+            if self.ctc.bias is not None:
+                fused.bias.add_(self.ctc.bias)
+            if outp.bias is not None:
+                fused.bias.add_(self.ctc.weight @ outp.bias)
+        self.ctc = fused
+        return True
+
     def beam_search(self, x: th.Tensor, **kwargs) -> List[Dict]:
         """
         CTC beam search if has CTC branch
@@ -181,6 +218,21 @@ class CtcASR(ASREncoderBase):
                 blank=self.vocab_size - 1,
                 **kwargs)
 
+    def quantize_for_inference(self) -> bool:
+        """
+        Apply int8 dynamic quantization to the CTC layer (only for inference
+        on CPU, call it after prepare_for_inference), return true if quantized
+        """
+        if self.training or not isinstance(self.ctc, nn.Linear):
+            return False
+        if self.ctc.weight.device.type != "cpu":
+            return False
+        # wrap as quantize_dynamic only swaps the child modules
+        self.ctc = th.quantization.quantize_dynamic(nn.Sequential(self.ctc),
+                                                    {nn.Linear},
+                                                    dtype=th.qint8)[0]
+        return True
+
     def ctc_align(self, x: th.Tensor, y: th.Tensor) -> Dict:
         """
         Do CTC viterbi align if has CTC branch
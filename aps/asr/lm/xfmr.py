@@ -31,6 +31,33 @@ class TorchXfmrLM(nn.Module):
         # output distribution
         self.dist = nn.Linear(att_dim, vocab_size)
         self.vocab_size = vocab_size
+        # cached causal mask, sliced for each forward
+        self.register_buffer("sub_mask", th.zeros(0, 0), persistent=False)
+
+    def quantize_for_inference(self) -> bool:
+        """
+        Apply int8 dynamic quantization to the output layer (only for
+        inference on CPU), return true if quantized
+        """
+        if self.training or not isinstance(self.dist, nn.Linear):
+            return False
+        if self.dist.weight.device.type != "cpu":
+            return False
+        # wrap as quantize_dynamic only swaps the child modules
+        self.dist = th.quantization.quantize_dynamic(nn.Sequential(self.dist),
+                                                     {nn.Linear},
+                                                     dtype=th.qint8)[0]
+        return True
+
+    def _sub_mask(self, T: int, device: th.device) -> th.Tensor:
+        """
+        Return T x T causal mask from the cache (grow it if needed)
+        """
+        if self.sub_mask.shape[0] < T or self.sub_mask.device != device:
+            # double the size to avoid re-allocation at each decoding step
+            size = max(T, self.sub_mask.shape[0] * 2)
+            self.sub_mask = prep_sub_mask(size, device=device)
+        return self.sub_mask[:T, :T]
 
     def forward(
             self,
@@ -54,10 +81,9 @@ class TorchXfmrLM(nn.Module):
         hidden = token_embed if hidden is None else th.cat(
             [hidden, token_embed], dim=0)
         # tgt_mask: T x T
-        tgt_mask = prep_sub_mask(hidden.shape[0], device=hidden.device)
+        tgt_mask = self._sub_mask(hidden.shape[0], hidden.device)
         # src_pad_mask: N x T
-        src_pad_mask = None if token_len is None else (padding_mask(token_len)
-                                                       == 1)
+        src_pad_mask = None if token_len is None else padding_mask(token_len)
         # Ti x N x D
         enc_out = self.encoder(hidden,
                                inj_pose=None,
@@ -67,3 +93,46 @@ class TorchXfmrLM(nn.Module):
         output = self.dist(enc_out)
         # N x Ti x V
         return output.transpose(0, 1), hidden
+
+    def step(
+            self,
+            token: th.Tensor,
+            kv_cache: Optional[th.Tensor] = None,
+            token_len: Optional[th.Tensor] = None
+    ) -> Tuple[th.Tensor, th.Tensor]:
+        """
+        Incremental forward (used in beam search): only the new tokens are
+        passed through the encoder and attend to the cached keys & values
+        args:
+            token: new input tokens, N x T
+            kv_cache: key/value cache of each layer, S x N x L x 2E
+            token_len: length of the new tokens, N or None
+        return:
+            output: N x T x V
+            kv_cache: S+T x N x L x 2E
+        """
+        S = 0 if kv_cache is None else kv_cache.shape[0]
+        # N x T => T x N x E
+        token_embed = self.abs_pos_enc(self.vocab_embed(token), t=S)
+        T = token_embed.shape[0]
+        # T x S+T, the last T rows of the causal mask
+        tgt_mask = self._sub_mask(S + T, token_embed.device)[S:]
+        # N x S+T
+        src_pad_mask = None
+        if token_len is not None:
+            src_pad_mask = padding_mask(token_len)
+            # history is never masked
+            src_pad_mask = th.cat([
+                src_pad_mask.new_zeros(src_pad_mask.shape[0], S),
+                src_pad_mask
+            ], -1)
+        # T x N x E
+        enc_out, kv_cache = self.encoder.step(
+            token_embed,
+            kv_cache=kv_cache,
+            src_mask=tgt_mask,
+            src_key_padding_mask=src_pad_mask)
+        # T x N x V
+        output = self.dist(enc_out)
+        # N x T x V
+        return output.transpose(0, 1), kv_cache
@@ -198,7 +198,7 @@ class TorchTransformerDecoder(DecoderBase):
             output: N x Ti x To+1 x V
         """
         # N x Ti
-        pad_mask = None if tgt_len is None else (padding_mask(tgt_len) == 1)
+        pad_mask = None if tgt_len is None else padding_mask(tgt_len)
         # genrarte target masks (-inf/0)
         tgt_mask = prep_sub_mask(tgt_pad.shape[-1], device=tgt_pad.device)
         # To+1 x N x E
@@ -5,9 +5,10 @@
 
 import torch as th
 import torch.nn as nn
+import torch.nn.functional as tf
 
 from torch.nn import MultiheadAttention, TransformerDecoder
-from typing import Tuple, Optional, Dict
+from typing import Tuple, Optional, Dict, List
 from aps.asr.xfmr.pose import get_xfmr_pose
 from aps.asr.xfmr.utils import get_activation_fn, prep_sub_mask
 from aps.asr.base.attention import padding_mask
@@ -43,6 +44,60 @@ class TransformerDncoderLayer(nn.Module):
         self.dropout1 = nn.Dropout(ffn_dropout)
         self.dropout2 = nn.Dropout(ffn_dropout)
 
+    def memory_kv(self, memory: th.Tensor) -> th.Tensor:
+        """
+        Project the memory (encoder output) to the key & value of the
+        encoder-decoder attention, which are constant during decoding
+        Args:
+            memory (Tensor): S x N x D
+        Return:
+            memory_kv (Tensor): S x N x 2D
+        """
+        D = memory.shape[-1]
+        weight = self.multihead_attn.in_proj_weight
+        bias = self.multihead_attn.in_proj_bias
+        return tf.linear(memory, weight[D:],
+                         None if bias is None else bias[D:])
+
+    def cached_multihead_attn(
+            self,
+            tgt: th.Tensor,
+            memory_kv: th.Tensor,
+            memory_key_padding_mask: Optional[th.Tensor] = None
+    ) -> th.Tensor:
+        """
+        Encoder-decoder attention with the projected memory
+        Args:
+            tgt (Tensor): T x N x D
+            memory_kv (Tensor): S x N x 2D
+            memory_key_padding_mask (Tensor or None): N x S
+        Return
+            out (Tensor): T x N x D
+        """
+        T, N, D = tgt.shape
+        H = self.multihead_attn.num_heads
+        weight = self.multihead_attn.in_proj_weight
+        bias = self.multihead_attn.in_proj_bias
+        # T x N x D
+        query = tf.linear(tgt, weight[:D], None if bias is None else bias[:D])
+        # T x N x H x D'
+        query = query.view(T, N, H, -1) * (D // H)**-0.5
+        # S x N x H x D'
+        key, value = [
+            m.view(m.shape[0], N, H, -1) for m in memory_kv.chunk(2, dim=-1)
+        ]
+        # T x N x H x S
+        logit = th.einsum("tnhd,snhd->tnhs", query, key)
+        if memory_key_padding_mask is not None:
+            logit = logit.masked_fill(memory_key_padding_mask[None, :, None],
+                                      float("-inf"))
+        weight = tf.dropout(th.softmax(logit, dim=-1),
+                            p=self.multihead_attn.dropout,
+                            training=self.training)
+        # T x N x H x D'
+        context = th.einsum("tnhs,snhd->tnhd", weight, value)
+        return self.multihead_attn.out_proj(context.reshape(T, N, D))
+
     def forward(
             self,
             tgt: th.Tensor,
@@ -50,7 +105,8 @@ class TransformerDncoderLayer(nn.Module):
             tgt_mask: Optional[th.Tensor] = None,
             memory_mask: Optional[th.Tensor] = None,
             tgt_key_padding_mask: Optional[th.Tensor] = None,
-            memory_key_padding_mask: Optional[th.Tensor] = None) -> th.Tensor:
+            memory_key_padding_mask: Optional[th.Tensor] = None,
+            memory_kv: Optional[th.Tensor] = None) -> th.Tensor:
         """
         Get decoder output (support pre_norm & post_norm)
         Args:
@@ -60,6 +116,7 @@ class TransformerDncoderLayer(nn.Module):
             memory_mask (Tensor or None): T x S
             tgt_key_padding_mask (Tensor or None): N x T
             memory_key_padding_mask (Tensor or None): N x S
+            memory_kv (Tensor or None): S x N x 2D, see memory_kv(...)
         Return
             out (Tensor): T x N x D
         """
@@ -79,11 +136,18 @@ class TransformerDncoderLayer(nn.Module):
         skip_add = tgt
         if self.pre_norm:
             tgt = self.norm2(tgt)
-        tgt, _ = self.multihead_attn(tgt,
-                                     memory,
-                                     memory,
-                                     attn_mask=memory_mask,
-                                     key_padding_mask=memory_key_padding_mask)
+        if memory_kv is None:
+            tgt, _ = self.multihead_attn(
+                tgt,
+                memory,
+                memory,
+                attn_mask=memory_mask,
+                key_padding_mask=memory_key_padding_mask)
+        else:
+            tgt = self.cached_multihead_attn(
+                tgt,
+                memory_kv,
+                memory_key_padding_mask=memory_key_padding_mask)
 
         tgt = skip_add + self.dropout2(tgt)
         if not self.pre_norm:
@@ -125,27 +189,40 @@ class TorchTransformerDecoder(nn.Module):
         self.output = nn.Linear(att_dim, vocab_size, bias=False)
         self.vocab_size = vocab_size
 
+    def memory_cache(self, enc_out: th.Tensor) -> List[th.Tensor]:
+        """
+        Return the key & value of the encoder-decoder attention for each
+        layer, computed once before decoding and passed to step(...)
+        Args:
+            enc_out (Tensor): T x N x D
+        Return:
+            memory_kv (list[Tensor]): T x N x 2D
+        """
+        return [layer.memory_kv(enc_out) for layer in self.decoder.layers]
+
     def step(self,
              enc_out: th.Tensor,
              tgt_pad: th.Tensor,
              enc_len: Optional[th.Tensor] = None,
              tgt_len: Optional[th.Tensor] = None,
              pre_emb: Optional[th.Tensor] = None,
-             out_idx: Optional[int] = None) -> Tuple[th.Tensor]:
+             out_idx: Optional[int] = None,
+             memory_kv: Optional[List[th.Tensor]] = None) -> Tuple[th.Tensor]:
         """
         Args:
             enc_out (Tensor): T x N x D
             tgt_pad (Tensor): N x To
             enc_len (Tensor): N or None
             pre_emb (Tensor): T' x N x D
+            memory_kv (list[Tensor]): output of memory_cache(enc_out)
         Return:
             dec_out (Tensor): T+T' x N x D or N x D
             tgt_emb (Tensor): T+T' x N x E
         """
         # N x Ti
         offset = 0 if pre_emb is None else pre_emb.shape[0]
-        mem_pad_mask = None if enc_len is None else (padding_mask(enc_len) == 1)
-        tgt_pad_mask = None if tgt_len is None else (padding_mask(tgt_len) == 1)
+        mem_pad_mask = None if enc_len is None else padding_mask(enc_len)
+        tgt_pad_mask = None if tgt_len is None else padding_mask(tgt_len)
         # N x T x E
         tgt_emb = self.vocab_embed(tgt_pad)
         # T x N x E
@@ -156,11 +233,23 @@ class TorchTransformerDecoder(nn.Module):
         # T+T' x T+T'
         tgt_mask = prep_sub_mask(tgt_emb.shape[0], device=tgt_pad.device)
         # To+1 x N x D
-        dec_out = self.decoder(tgt_emb,
-                               enc_out,
-                               tgt_mask=tgt_mask,
-                               tgt_key_padding_mask=tgt_pad_mask,
-                               memory_key_padding_mask=mem_pad_mask)
+        if memory_kv is None:
+            dec_out = self.decoder(tgt_emb,
+                                   enc_out,
+                                   tgt_mask=tgt_mask,
+                                   tgt_key_padding_mask=tgt_pad_mask,
+                                   memory_key_padding_mask=mem_pad_mask)
+        else:
+            dec_out = tgt_emb
+            for layer, layer_kv in zip(self.decoder.layers, memory_kv):
+                dec_out = layer(dec_out,
+                                enc_out,
+                                tgt_mask=tgt_mask,
+                                tgt_key_padding_mask=tgt_pad_mask,
+                                memory_key_padding_mask=mem_pad_mask,
+                                memory_kv=layer_kv)
+            if self.decoder.norm is not None:
+                dec_out = self.decoder.norm(dec_out)
         if out_idx is not None:
             dec_out = dec_out[out_idx]
         # To+1 x N x V
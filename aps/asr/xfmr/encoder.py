@@ -19,6 +19,9 @@ class TransformerEncoder(nn.Module):
     """
     Transformer based encoders. Currently the arch supports {xfmr|cfmr} and pose supports {abs|rel|xl|conv1d}
     """
+    # cache of the relative positional encodings (for evaluation)
+    pose_cache: Dict[int, th.Tensor]
+    max_pose_cache: int = 32
 
     def __init__(self,
                  arch: str,
@@ -29,7 +32,8 @@ class TransformerEncoder(nn.Module):
                  proj_kwargs: Dict = {},
                  pose: str = "abs",
                  pose_kwargs: Dict = {},
-                 arch_kwargs: Dict = {}):
+                 arch_kwargs: Dict = {},
+                 autocast: bool = False):
         super(TransformerEncoder, self).__init__()
         if proj == "none":
             self.proj = None
@@ -44,6 +48,92 @@ class TransformerEncoder(nn.Module):
         self.encoder = get_xfmr_encoder(arch, self.pose_type, num_layers,
                                         arch_kwargs)
         self.casual = casual
+        # apply causal masking inside the sdpa kernels if possible
+        self.causal_sdpa = casual and self.pose_type == "abs" and all(
+            layer.self_attn.use_sdpa for layer in self.encoder.layers)
+        if self.causal_sdpa:
+            for layer in self.encoder.layers:
+                layer.self_attn.causal = True
+        self.pose_cache = {}
+        self.autocast = autocast
+        # cached causal mask, sliced for each forward
+        self.register_buffer("sub_mask", th.zeros(0, 0), persistent=False)
+
+    def inference_module(self, script: Optional[bool] = None) -> nn.Module:
+        """
+        Select the eager or TorchScript version of the encoder (in evaluation
+        mode) for inference
+        Args:
+            script (bool or None): return the scripted encoder if true and
+                the eager one if false. If None, keep the eager encoder when
+                the layers run the fused sdpa kernels (torch >= 2.0), which
+                are skipped under TorchScript, and script it otherwise
+        """
+        self.eval()
+        if script is None:
+            script = not any(layer.self_attn.use_sdpa
+                             for layer in self.encoder.layers)
+        return th.jit.script(self) if script else self
+
+    def train(self, mode: bool = True) -> nn.Module:
+        # parameters of the positional encodings may be changed
+        self.pose_cache.clear()
+        return super(TransformerEncoder, self).train(mode)
+
+    def _sub_mask(self, T: int, device: th.device) -> th.Tensor:
+        """
+        Return T x T causal mask from the cache (grow it if needed)
+        """
+        if self.sub_mask.shape[0] < T or self.sub_mask.device != device:
+            size = max(T, self.sub_mask.shape[0] * 2)
+            self.sub_mask = prep_sub_mask(size, device=device)
+        return self.sub_mask[:T, :T]
+
+    def _rel_pose(self, nframes: int, device: th.device) -> th.Tensor:
+        """
+        Return relative positional encodings: 2Ti-1 x D
+        """
+        if self.pose_type == "rel":
+            return self.pose(th.arange(-nframes + 1, nframes, device=device))
+        else:
+            return self.pose(
+                th.arange(0, 2 * nframes - 1, 1.0, device=device))
+
+    @th.jit.unused
+    def _cached_rel_pose(self, nframes: int, device: th.device) -> th.Tensor:
+        """
+        Cached version of _rel_pose(...) used in evaluation mode
+        """
+        if nframes in self.pose_cache:
+            inj_pose = self.pose_cache[nframes]
+            if inj_pose.device == device:
+                return inj_pose
+        if len(self.pose_cache) >= self.max_pose_cache:
+            # drop the oldest one
+            self.pose_cache.pop(next(iter(self.pose_cache)))
+        with th.no_grad():
+            inj_pose = self._rel_pose(nframes, device)
+        self.pose_cache[nframes] = inj_pose
+        return inj_pose
+
+    @th.jit.unused
+    def autocast_encoder(self, enc_inp: th.Tensor,
+                         inj_pose: Optional[th.Tensor],
+                         src_mask: Optional[th.Tensor],
+                         src_pad_mask: Optional[th.Tensor]) -> th.Tensor:
+        """
+        Run the transformer layers in BF16 (FP16 if BF16 is not supported),
+        the positional encodings are computed outside in FP32
+        """
+        kwargs = {}
+        if getattr(th.cuda, "is_bf16_supported", lambda: False)():
+            kwargs["dtype"] = th.bfloat16
+        with th.cuda.amp.autocast(**kwargs):
+            enc_out = self.encoder(enc_inp,
+                                   inj_pose=inj_pose,
+                                   src_mask=src_mask,
+                                   src_key_padding_mask=src_pad_mask)
+        return enc_out.float()
 
     def forward(self, inp_pad: th.Tensor,
                 inp_len: Optional[th.Tensor]) -> EncRetType:
@@ -63,8 +153,11 @@ class TransformerEncoder(nn.Module):
             inp_len = self.proj.num_frames(inp_len)
             enc_inp = self.proj(inp_pad)
 
-        src_pad_mask = None if inp_len is None else (padding_mask(inp_len) == 1)
         nframes = enc_inp.shape[1]
+        device = enc_inp.device
+        # N x Ti, use the known width to skip max(inp_len) (a device sync)
+        src_pad_mask = None if inp_len is None else padding_mask(
+            inp_len, max_len=nframes)
 
         if self.pose_type == "abs":
             # enc_inp: N x Ti x D => Ti x N x D
@@ -75,21 +168,22 @@ class TransformerEncoder(nn.Module):
             # enc_inp: N x Ti x D => Ti x N x D
             enc_inp = enc_inp.transpose(0, 1)
             # 2Ti-1 x D
-            if self.pose_type == "rel":
-                inj_pose = self.pose(
-                    th.arange(-nframes + 1, nframes, device=enc_inp.device))
+            if not self.training and not th.jit.is_scripting():
+                inj_pose = self._cached_rel_pose(nframes, device)
             else:
-                inj_pose = self.pose(
-                    th.arange(0, 2 * nframes - 1, 1.0, device=enc_inp.device))
-        # src_mask: Ti x Ti
-        if self.casual:
-            src_mask = prep_sub_mask(nframes, device=enc_inp.device)
-        else:
-            src_mask = None
+                inj_pose = self._rel_pose(nframes, device)
+        # src_mask: Ti x Ti, not needed if the sdpa kernels do causal masking
+        src_mask = None
+        if self.casual and (th.jit.is_scripting() or not self.causal_sdpa):
+            src_mask = self._sub_mask(nframes, device)
         # Ti x N x D
-        enc_out = self.encoder(enc_inp,
-                               inj_pose=inj_pose,
-                               src_mask=src_mask,
-                               src_key_padding_mask=src_pad_mask)
+        if self.autocast and enc_inp.is_cuda:
+            enc_out = self.autocast_encoder(enc_inp, inj_pose, src_mask,
+                                            src_pad_mask)
+        else:
+            enc_out = self.encoder(enc_inp,
+                                   inj_pose=inj_pose,
+                                   src_mask=src_mask,
+                                   src_key_padding_mask=src_pad_mask)
         # N x Ti x D
         return enc_out.transpose(0, 1), inp_len
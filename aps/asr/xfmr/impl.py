@@ -13,6 +13,7 @@ import torch.nn.functional as tf
 from typing import Optional, Tuple, Dict, List
 from aps.libs import Register
 from aps.asr.xfmr.utils import digit_shift, get_activation_fn, get_relative_uv
+from aps.asr.xfmr.utils import batched_dot_att
 
 TransformerEncoderLayers = Register("xfmr_encoder_layer")
 MHSAReturnType = List[th.Tensor]
@@ -28,7 +29,8 @@ class ApsMultiheadAttention(nn.Module):
                  num_heads: int,
                  dropout: float = 0,
                  bias: bool = True,
-                 use_torch: bool = True) -> None:
+                 use_torch: bool = True,
+                 use_sdpa: bool = False) -> None:
         super(ApsMultiheadAttention, self).__init__()
         self.embed_dim = embed_dim
         self.num_heads = num_heads
@@ -45,6 +47,23 @@ class ApsMultiheadAttention(nn.Module):
         self.out_proj = nn.Linear(embed_dim, embed_dim, bias=True)
         self.dropout = nn.Dropout(p=dropout)
         self.use_torch = use_torch
+        # fused attention kernels (e.g., FlashAttention) from torch >= 2.0,
+        # only used if the attention weights are not required
+        self.use_sdpa = use_sdpa and hasattr(tf,
+                                             "scaled_dot_product_attention")
+        # causal masking inside the sdpa kernel (no L x S mask), set by
+        # the owner (see aps.asr.xfmr.encoder.TransformerEncoder)
+        self.causal = False
+
+    def slice_proj(self, inp: th.Tensor, beg: int, end: int) -> th.Tensor:
+        """
+        Apply the [beg, end) rows of the input projection (in_proj_bias may be
+        None if bias = False)
+        """
+        if self.in_proj_bias is None:
+            return tf.linear(inp, self.in_proj_weight[beg:end], None)
+        return tf.linear(inp, self.in_proj_weight[beg:end],
+                         self.in_proj_bias[beg:end])
 
     def inp_proj(self, query: th.Tensor, key: th.Tensor,
                  value: th.Tensor) -> Tuple[th.Tensor, th.Tensor, th.Tensor]:
@@ -64,21 +83,14 @@ class ApsMultiheadAttention(nn.Module):
             stack = tf.linear(query, self.in_proj_weight, self.in_proj_bias)
             query, key, value = th.chunk(stack, 3, dim=-1)
         else:
-            query = tf.linear(query, self.in_proj_weight[:self.embed_dim],
-                              self.in_proj_bias[:self.embed_dim])
+            E = self.embed_dim
+            query = self.slice_proj(query, 0, E)
             if th.equal(key, value):
-                stack = tf.linear(key, self.in_proj_weight[self.embed_dim:],
-                                  self.in_proj_bias[self.embed_dim:])
+                stack = self.slice_proj(key, E, 3 * E)
                 key, value = th.chunk(stack, 2, dim=-1)
             else:
-                base = self.embed_dim
-                key = tf.linear(key,
-                                self.in_proj_weight[base:base + self.embed_dim],
-                                self.in_proj_bias[base:base + self.embed_dim])
-                base += self.embed_dim
-                value = tf.linear(
-                    value, self.in_proj_weight[base:base + self.embed_dim],
-                    self.in_proj_bias[base:base + self.embed_dim])
+                key = self.slice_proj(key, E, 2 * E)
+                value = self.slice_proj(value, 2 * E, 3 * E)
         query, key, value = [
             m.view(m.shape[0], -1, self.num_heads, self.head_dim)
             for m in [query, key, value]
@@ -182,6 +194,63 @@ class ApsMultiheadAttention(nn.Module):
         else:
             return [context, weight]
 
+    @th.jit.unused
+    def sdpa_forward(
+            self,
+            query: th.Tensor,
+            key: th.Tensor,
+            value: th.Tensor,
+            key_padding_mask: Optional[th.Tensor] = None,
+            attn_mask: Optional[th.Tensor] = None) -> MHSAReturnType:
+        """
+        Using th.nn.functional.scaled_dot_product_attention, which dispatches
+        to the fused kernels and never materializes the L x S weight
+        Args:
+            query (Tensor): L x N x E
+            key (Tensor): S x N x E
+            value (Tensor): S x N x E
+            key_padding_mask (Tensor): N x S
+            attn_mask (Tensor): L x S, additional mask (-inf/0)
+        Return:
+            context (Tensor): L x N x E
+        """
+        # T x N x H x D => N x H x T x D
+        query, key, value = [
+            m.permute(1, 2, 0, 3) for m in self.inp_proj(query, key, value)
+        ]
+        mask = None
+        if attn_mask is not None:
+            # 1 x 1 x L x S
+            mask = attn_mask[None, None].to(query.dtype)
+        is_causal = self.causal and attn_mask is None
+        if key_padding_mask is not None:
+            # N x 1 x 1 x S
+            pad_mask = key_padding_mask[:, None, None, :]
+            if mask is None:
+                mask = ~pad_mask
+            else:
+                mask = mask.masked_fill(pad_mask, float("-inf"))
+            # is_causal can't be used together with attn_mask
+            if is_causal:
+                L, S = query.shape[2], key.shape[2]
+                # L x S, lower triangle
+                causal_mask = th.ones(L, S, dtype=th.bool,
+                                      device=query.device).tril()
+                mask = mask & causal_mask
+                is_causal = False
+        # N x H x L x D
+        context = tf.scaled_dot_product_attention(
+            query,
+            key,
+            value,
+            attn_mask=mask,
+            dropout_p=self.dropout.p if self.training else 0.0,
+            is_causal=is_causal)
+        # N x H x L x D => L x N x HD
+        context = context.permute(2, 0, 1, 3).reshape(context.shape[2], -1,
+                                                      self.embed_dim)
+        return [self.out_proj(context)]
+
     def forward(self,
                 query: th.Tensor,
                 key: th.Tensor,
@@ -199,8 +268,14 @@ class ApsMultiheadAttention(nn.Module):
             attn_mask (Tensor): L x S, additional mask
         Return:
             context (Tensor): L x N x E
-            weight (Tensor): N x L x S
+            weight (Tensor): N x L x S (not returned if use_sdpa = True)
         """
+        if self.use_sdpa and not th.jit.is_scripting():
+            return self.sdpa_forward(query,
+                                     key,
+                                     value,
+                                     key_padding_mask=key_padding_mask,
+                                     attn_mask=attn_mask)
         if self.use_torch:
             return self.torch_forward(query,
                                       key,
@@ -219,6 +294,42 @@ class ApsMultiheadAttention(nn.Module):
                                               key_padding_mask=key_padding_mask)
         return self.wrap_out(context, weight)
 
+    def step(
+        self,
+        query: th.Tensor,
+        kv_cache: Optional[th.Tensor] = None,
+        key_padding_mask: Optional[th.Tensor] = None,
+        attn_mask: Optional[th.Tensor] = None
+    ) -> Tuple[th.Tensor, th.Tensor]:
+        """
+        Incremental self-attention (with key/value cache)
+        Args:
+            query (Tensor): L x N x E, new inputs
+            kv_cache (Tensor or None): S x N x 2E, projected key & value
+            key_padding_mask (Tensor): N x S+L
+            attn_mask (Tensor): L x S+L, additional mask
+        Return:
+            context (Tensor): L x N x E
+            kv_cache (Tensor): S+L x N x 2E, updated cache
+        """
+        # L x N x 2E
+        kv = self.slice_proj(query, self.embed_dim, 3 * self.embed_dim)
+        kv_cache = kv if kv_cache is None else th.cat([kv_cache, kv], 0)
+        query = self.slice_proj(query, 0, self.embed_dim)
+        key, value = th.chunk(kv_cache, 2, dim=-1)
+        query, key, value = [
+            m.contiguous().view(m.shape[0], -1, self.num_heads, self.head_dim)
+            for m in [query, key, value]
+        ]
+        # L x N x H x S+L
+        logit = self.dot_att(query, key)
+        context, weight = self.context_weight(logit,
+                                              value,
+                                              attn_mask=attn_mask,
+                                              key_padding_mask=key_padding_mask)
+        context, _ = self.wrap_out(context, weight)
+        return context, kv_cache
+
 
 class RelMultiheadAttention(ApsMultiheadAttention):
     """
@@ -247,7 +358,6 @@ class RelMultiheadAttention(ApsMultiheadAttention):
         Return:
             logit (Tensor): L x N x H x S
         """
-        term_a = th.einsum("lnhd,snhd->lnhs", query, key)
         # 1) key_rel_pose is L x S x D
         #   a)  term_b = th.einsum(
         #           "...hd,...sd->...hs", query,
@@ -256,8 +366,8 @@ class RelMultiheadAttention(ApsMultiheadAttention):
         # 2) key_rel_pose is 2L-1 x D
         # L x N x H x 2L-1
         term_b = th.matmul(query, key_rel_pose.transpose(0, 1))
-        # L x N x H x S
-        return term_a + digit_shift(term_b)
+        # L x N x H x S, term_a (query * key^T) is added in the batched GEMM
+        return batched_dot_att(query, key, digit_shift(term_b))
 
     def forward(self,
                 query: th.Tensor,
@@ -329,15 +439,13 @@ class XlMultiheadAttention(ApsMultiheadAttention):
         Return:
             logit (Tensor): L x N x H x S(L)
         """
-        # L x N x H x S
-        term_ac = th.einsum("lnhd,snhd->lnhs", query + self.rel_u, key)
         # 2S-1 x E => 2S-1 x H x D
         rel_pos = self.rel_proj(sin_pose)
         rel_pos = rel_pos.view(-1, self.num_heads, self.head_dim)
         # L x N x H x 2S-1
         term_bd = th.einsum("lnhd,shd->lnhs", query + self.rel_v, rel_pos)
-        # L x N x H x S
-        return term_ac + digit_shift(term_bd)
+        # L x N x H x S, term_ac is added in the batched GEMM
+        return batched_dot_att(query + self.rel_u, key, digit_shift(term_bd))
 
     def forward(self,
                 query: th.Tensor,
@@ -413,12 +521,12 @@ class ApsTransformerEncoderLayer(nn.Module):
         inp = src
         if self.pre_norm:
             src = self.norm1(src)
-        att, _ = self.self_attn(src,
-                                src,
-                                src,
-                                inj_pose,
-                                attn_mask=src_mask,
-                                key_padding_mask=src_key_padding_mask)
+        att = self.self_attn(src,
+                             src,
+                             src,
+                             inj_pose,
+                             attn_mask=src_mask,
+                             key_padding_mask=src_key_padding_mask)[0]
         src = inp + self.dropout(att)
         if self.pre_norm:
             src = src + self.feedforward(self.norm2(src))
@@ -427,6 +535,40 @@ class ApsTransformerEncoderLayer(nn.Module):
             src = self.norm2(src + self.feedforward(src))
         return src
 
+    def step(
+        self,
+        src: th.Tensor,
+        kv_cache: Optional[th.Tensor] = None,
+        src_mask: Optional[th.Tensor] = None,
+        src_key_padding_mask: Optional[th.Tensor] = None
+    ) -> Tuple[th.Tensor, th.Tensor]:
+        """
+        Incremental forward (only for self_attn = ApsMultiheadAttention)
+        Args:
+            src (Tensor): L x N x D, new inputs
+            kv_cache (None or Tensor): S x N x 2D
+            src_mask (None or Tensor): L x S+L
+            src_key_padding_mask (None or Tensor): N x S+L
+        Return:
+            out (Tensor): L x N x D
+            kv_cache (Tensor): S+L x N x 2D
+        """
+        inp = src
+        if self.pre_norm:
+            src = self.norm1(src)
+        att, kv_cache = self.self_attn.step(
+            src,
+            kv_cache=kv_cache,
+            attn_mask=src_mask,
+            key_padding_mask=src_key_padding_mask)
+        src = inp + self.dropout(att)
+        if self.pre_norm:
+            src = src + self.feedforward(self.norm2(src))
+        else:
+            src = self.norm1(src)
+            src = self.norm2(src + self.feedforward(src))
+        return src, kv_cache
+
 
 class ApsConformerEncoderLayer(nn.Module):
     """
@@ -506,12 +648,12 @@ class ApsConformerEncoderLayer(nn.Module):
             src1 = src
         # self-attention block
         src2 = self.norm1(src1)
-        att, _ = self.self_attn(src2,
-                                src2,
-                                src2,
-                                inj_pose,
-                                attn_mask=src_mask,
-                                key_padding_mask=src_key_padding_mask)
+        att = self.self_attn(src2,
+                             src2,
+                             src2,
+                             inj_pose,
+                             attn_mask=src_mask,
+                             key_padding_mask=src_key_padding_mask)[0]
         src = src1 + self.dropout(att)
         # conv
         src = self.conv(self.norm2(src)) + src
@@ -540,7 +682,8 @@ class TransformerEncoderLayer(ApsTransformerEncoderLayer):
         self_attn = ApsMultiheadAttention(att_dim,
                                           nhead,
                                           dropout=att_dropout,
-                                          use_torch=True)
+                                          use_torch=True,
+                                          use_sdpa=True)
         super(TransformerEncoderLayer,
               self).__init__(att_dim,
                              self_attn,
@@ -621,7 +764,8 @@ class ConformerEncoderLayer(ApsConformerEncoderLayer):
         self_attn = ApsMultiheadAttention(att_dim,
                                           nhead,
                                           dropout=att_dropout,
-                                          use_torch=True)
+                                          use_torch=True,
+                                          use_sdpa=True)
         super(ConformerEncoderLayer,
               self).__init__(att_dim,
                              self_attn,
@@ -727,6 +871,37 @@ class ApsTransformerEncoder(nn.Module):
 
         return out
 
+    def step(
+        self,
+        src: th.Tensor,
+        kv_cache: Optional[th.Tensor] = None,
+        src_mask: Optional[th.Tensor] = None,
+        src_key_padding_mask: Optional[th.Tensor] = None
+    ) -> Tuple[th.Tensor, th.Tensor]:
+        """
+        Incremental forward with the key/value cache of each layer
+        Args:
+            src (Tensor): L x N x D, new inputs
+            kv_cache (None or Tensor): S x N x num_layers x 2D
+        Return:
+            out (Tensor): L x N x D
+            kv_cache (Tensor): S+L x N x num_layers x 2D
+        """
+        out = src
+        new_cache = []
+        for i, mod in enumerate(self.layers):
+            out, cache = mod.step(
+                out,
+                kv_cache=None if kv_cache is None else kv_cache[:, :, i],
+                src_mask=src_mask,
+                src_key_padding_mask=src_key_padding_mask)
+            new_cache.append(cache)
+
+        if self.norm is not None:
+            out = self.norm(out)
+
+        return out, th.stack(new_cache, 2)
+
 
 def get_xfmr_encoder(arch: str, pose: str, num_layers: int,
                      arch_kwargs: Dict) -> nn.Module:
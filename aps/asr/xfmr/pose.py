@@ -125,8 +125,8 @@ class InputSinPosEncoding(SinPosEncoding):
         pos = th.arange(t, t + inp.shape[1], 1.0, device=inp.device)
         # T x D
         sin_enc = self._get_sin_pos_enc(pos)
-        # add dropout
-        out = self.dropout(inp * self.factor + sin_enc)
+        # scale & add in one kernel: sin_enc + factor * inp, N x T x D
+        out = self.dropout(th.add(sin_enc, inp, alpha=self.factor))
         # T x N x D
         out = out.transpose(0, 1)
         return out
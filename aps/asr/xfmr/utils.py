@@ -38,6 +38,31 @@ def digit_shift(term: th.Tensor) -> th.Tensor:
     return term.transpose(1, -1)
 
 
+def batched_dot_att(query: th.Tensor, key: th.Tensor,
+                    bias: th.Tensor) -> th.Tensor:
+    """
+    Return bias + query * key^T (for all batches & heads) with one strided
+    batched GEMM, which saves the separate add of the positional term
+    Args:
+        query (Tensor): L x N x H x D
+        key (Tensor): S x N x H x D
+        bias (Tensor): L x N x H x S
+    Return:
+        logit (Tensor): L x N x H x S
+    """
+    L, N, H, D = query.shape
+    S = key.shape[0]
+    # NH x L x D
+    query = query.permute(1, 2, 0, 3).reshape(N * H, L, D)
+    # NH x D x S
+    key = key.permute(1, 2, 3, 0).reshape(N * H, D, S)
+    # NH x L x S
+    bias = bias.permute(1, 2, 0, 3).reshape(N * H, L, S)
+    logit = th.baddbmm(bias, query, key)
+    # L x N x H x S
+    return logit.view(N, H, L, S).permute(2, 0, 1, 3)
+
+
 def prep_sub_mask(T: int, device: th.device = "cpu") -> th.Tensor:
     """
     Prepare a square sub-sequence masks (-inf/0)
@@ -51,9 +76,7 @@ def prep_sub_mask(T: int, device: th.device = "cpu") -> th.Tensor:
         [0., 0., 0., 0., 0., 0., 0., -inf],
         [0., 0., 0., 0., 0., 0., 0., 0.]])
     """
-    mask = (th.triu(th.ones(T, T, device=device), diagonal=1) == 1).float()
-    mask = mask.masked_fill(mask == 1, float("-inf"))
-    return mask
+    return th.full((T, T), float("-inf"), device=device).triu(diagonal=1)
 
 
 class Swish(nn.Module):
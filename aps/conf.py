@@ -3,11 +3,20 @@
 """
 Load {am,lm,se} training configurations
 """
+import os
+import copy
 import yaml
 import codecs
+import functools
 
 from typing import Dict, List, Tuple
 
+try:
+    # libyaml based loader (in C)
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 required_keys = [
     "nnet", "nnet_conf", "task", "task_conf", "data_conf", "trainer_conf"
 ]
@@ -18,20 +27,21 @@ all_am_conf_keys = required_keys + [
 all_lm_conf_keys = required_keys + ["cmd_args"]
 
 
-def load_dict(dict_path: str,
-              reverse: bool = False,
-              required: List[str] = ["<sos>", "<eos>"]) -> Dict:
+@functools.lru_cache(maxsize=8)
+def _load_dict(dict_path: str, reverse: bool, mtime_ns: int) -> Dict:
     """
-    Load the dictionary object
-    Args:
-        dict_path: path of the vocabulary dictionary
-        required: required units in the dict
-        reverse: return int:str if true, else str:int
+    Parse the dictionary file (cached by path, order & modification time)
     """
+    vocab = {}
     with codecs.open(dict_path, mode="r", encoding="utf-8") as fd:
-        vocab = {}
-        for line in fd:
-            tok, idx = line.split()
+        for n, line in enumerate(fd, 1):
+            fields = line.split()
+            if not fields:
+                continue
+            if len(fields) != 2:
+                raise RuntimeError(f"Expect <token> <index> in {dict_path} " +
+                                   f"(line {n}), got: {line.strip()}")
+            tok, idx = fields
             if reverse:
                 vocab[int(idx)] = tok
             else:
@@ -39,25 +49,59 @@ def load_dict(dict_path: str,
                     raise RuntimeError(
                         f"Duplicated token in {dict_path}: {tok}")
                 vocab[tok] = int(idx)
+    return vocab
+
+
+def load_dict(dict_path: str,
+              reverse: bool = False,
+              required: List[str] = ["<sos>", "<eos>"]) -> Dict:
+    """
+    Load the dictionary object. The file is parsed once per process, while
+    each call still returns an O(N) copy of the cached dict, so the callers
+    can modify it without affecting the others
+    Args:
+        dict_path: path of the vocabulary dictionary
+        required: required units in the dict
+        reverse: return int:str if true, else str:int
+    """
+    vocab = _load_dict(dict_path, reverse, os.stat(dict_path).st_mtime_ns)
     if not reverse:
         for token in required:
             if token not in vocab:
                 raise ValueError(f"Miss token: {token} in {dict_path}")
-    return vocab
+    return dict(vocab)
 
 
 def dump_dict(dict_path: str, vocab_dict: Dict, reverse: bool = False) -> None:
     """
     Dump the dictionary out
     """
-    dict_str = []
     # <int, str> if reverse else <str, int>
-    for key, val in vocab_dict.items():
-        if reverse:
-            val, key = key, val
-        dict_str.append(f"{key} {val:d}")
+    if reverse:
+        lines = (f"{val} {key:d}\n" for key, val in vocab_dict.items())
+    else:
+        lines = (f"{key} {val:d}\n" for key, val in vocab_dict.items())
     with codecs.open(dict_path, mode="w", encoding="utf-8") as fd:
-        fd.write("\n".join(dict_str))
+        fd.writelines(lines)
+
+
+@functools.lru_cache(maxsize=32)
+def _load_yaml(yaml_conf: str, mtime_ns: int, size: int) -> Dict:
+    """
+    Parse the yaml file (cached by path, modification time & size)
+    """
+    with open(yaml_conf, "r") as f:
+        return yaml.load(f, Loader=YamlLoader)
+
+
+def load_yaml(yaml_conf: str) -> Dict:
+    """
+    Load the yaml configurations. It returns a copy of the cached object, so
+    the caller can modify it freely
+    """
+    stat = os.stat(yaml_conf)
+    return copy.deepcopy(_load_yaml(yaml_conf, stat.st_mtime_ns,
+                                    stat.st_size))
 
 
 def check_conf(conf: Dict, required_keys: List[str],
@@ -65,17 +109,19 @@ def check_conf(conf: Dict, required_keys: List[str],
     """
     Check the format of the configurations
     """
-    # check the invalid item
-    for key in conf.keys():
-        if key not in all_keys:
-            raise ValueError(f"Get invalid configuration item: {key}")
+    # check the invalid items (report all of them)
+    invalid_keys = conf.keys() - frozenset(all_keys)
+    if invalid_keys:
+        raise ValueError(
+            f"Get invalid configuration item: {sorted(invalid_keys)}")
     # create task_conf if None
     if "task_conf" not in conf:
         conf["task_conf"] = {}
     # check the missing items
-    for key in required_keys:
-        if key not in conf.keys():
-            raise ValueError(f"Miss the item in the configuration: {key}?")
+    missing_keys = frozenset(required_keys) - conf.keys()
+    if missing_keys:
+        raise ValueError(
+            f"Miss the item in the configuration: {sorted(missing_keys)}?")
     return conf
 
 
@@ -83,8 +129,7 @@ def load_ss_conf(yaml_conf: str) -> Dict:
     """
     Load yaml configurations for speech separation/enhancement tasks
     """
-    with open(yaml_conf, "r") as f:
-        conf = yaml.full_load(f)
+    conf = load_yaml(yaml_conf)
     return check_conf(conf, required_keys, all_ss_conf_keys)
 
 
@@ -92,8 +137,7 @@ def load_lm_conf(yaml_conf: str, dict_path: str) -> Dict:
     """
     Load yaml configurations for language model training
     """
-    with open(yaml_conf, "r") as f:
-        conf = yaml.full_load(f)
+    conf = load_yaml(yaml_conf)
     conf = check_conf(conf, required_keys, all_lm_conf_keys)
     vocab = load_dict(dict_path)
     conf["nnet_conf"]["vocab_size"] = len(vocab)
@@ -104,8 +148,7 @@ def load_am_conf(yaml_conf: str, dict_path: str) -> Tuple[Dict, Dict]:
     """
     Load yaml configurations for acoustic model training
     """
-    with open(yaml_conf, "r") as f:
-        conf = yaml.full_load(f)
+    conf = load_yaml(yaml_conf)
     conf = check_conf(conf, required_keys, all_am_conf_keys)
 
     # add dict info
@@ -18,7 +18,7 @@ BACKEND = "none"
 
 __all__ = [
     "init", "rank", "local_rank", "world_size", "local_world_size",
-    "get_backend", "all_reduce", "hvd_available"
+    "get_backend", "all_reduce", "all_reduce_sum", "hvd_available"
 ]
 
 
@@ -127,3 +127,15 @@ def all_reduce(tensor: th.Tensor) -> th.Tensor:
     else:
         # default: avg
         return hvd.allreduce(tensor)
+
+
+def all_reduce_sum(tensor: th.Tensor) -> th.Tensor:
+    """
+    Return tensor summed over all the ranks
+    """
+    check_backend()
+    if BACKEND == "torch":
+        dist.all_reduce(tensor)
+        return tensor
+    else:
+        return hvd.allreduce(tensor, op=hvd.Sum)
@@ -7,6 +7,7 @@ import pathlib
 import torch as th
 
 from aps.libs import aps_transform, aps_nnet
+from aps.conf import load_yaml
 from aps.utils import get_logger
 from typing import Dict
 
@@ -22,8 +23,12 @@ def load_checkpoint(cpt_dir: str,
     cpt_dir = pathlib.Path(cpt_dir)
     # load checkpoint
     cpt = th.load(cpt_dir / f"{cpt_tag}.pt.tar", map_location="cpu")
-    with open(cpt_dir / "train.yaml", "r") as f:
-        conf = yaml.full_load(f)
+    try:
+        conf = load_yaml((cpt_dir / "train.yaml").as_posix())
+    except yaml.constructor.ConstructorError:
+        # train.yaml dumped by the old versions may contain python tags
+        with open(cpt_dir / "train.yaml", "r") as f:
+            conf = yaml.full_load(f)
     if nnet_cls is None:
         nnet_cls = aps_nnet(conf["nnet"])
     asr_transform = None
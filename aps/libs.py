@@ -13,6 +13,12 @@ from argparse import Namespace
 from aps import distributed
 from aps.utils import get_device_ids
 
+try:
+    # libyaml based dumper (in C)
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
+
 
 class Register(dict):
     """
@@ -241,11 +247,16 @@ def start_trainer(trainer: str,
                            tensorboard=args.tensorboard,
                            reduction_tag=reduction_tag,
                            **conf["trainer_conf"])
-    # save cmd options
+    # save cmd options (only on rank 0, the others never read it back)
     if rank in [0, None]:
         conf["cmd_args"] = vars(args)
+        try:
+            conf_str = yaml.dump(conf, Dumper=YamlDumper)
+        except yaml.representer.RepresenterError:
+            # non-plain python objects in the configurations
+            conf_str = yaml.dump(conf)
         with open(f"{args.checkpoint}/train.yaml", "w") as f:
-            yaml.dump(conf, f)
+            f.write(conf_str)
 
     data_conf = conf["data_conf"]
     loader_conf = {
@@ -261,8 +272,9 @@ def start_trainer(trainer: str,
                                 max_batch_size=args.batch_size // num_process,
                                 **loader_conf,
                                 **data_conf["train"])
+    # split the validation set across the ranks as well
     dev_loader = aps_dataloader(train=False,
-                                distributed=False,
+                                distributed=is_distributed,
                                 max_batch_size=args.batch_size //
                                 args.dev_batch_factor,
                                 **loader_conf,
@@ -14,17 +14,39 @@ from kaldi_python_io import Reader as BaseReader
 from aps.const import UNK_TOKEN
 
 
+def num_rank_batches(num_batches: int,
+                     distributed: bool = False,
+                     drop_last: bool = True) -> int:
+    """
+    Return #batches on the current rank (see derive_indices)
+    """
+    if not distributed:
+        return num_batches
+    world_size = dist.world_size()
+    if drop_last:
+        return num_batches // world_size
+    # the first (num_batches % world_size) ranks take one more batch
+    return (num_batches - dist.rank() + world_size - 1) // world_size
+
+
 def derive_indices(num_batches: int,
                    seed: int = 0,
                    shuffle: bool = True,
-                   distributed: bool = False) -> List[int]:
+                   distributed: bool = False,
+                   drop_last: bool = True) -> List[int]:
     """
     Return indices for BatchSampler
+    Args:
+        num_batches: total number of the batches
+        drop_last: in distributed mode, drop the last #num_batches % world_size
+                   batches to keep the same #batches on each rank (needed
+                   in training), otherwise the first ranks take one more
     """
     if distributed:
         rank = dist.rank()
         world_size = dist.world_size()
-        num_batches = num_batches * world_size
+        if drop_last:
+            num_batches = num_batches // world_size * world_size
     if shuffle:
         g = th.Generator()
         g.manual_seed(seed)
@@ -32,7 +54,7 @@ def derive_indices(num_batches: int,
     else:
         indices = th.arange(num_batches).tolist()
     if distributed:
-        return indices[rank:num_batches:world_size]
+        return indices[rank::world_size]
     else:
         return indices
 
@@ -197,6 +219,7 @@ class BatchSampler(dat.Sampler):
         batch_mode: "adaptive" or "constraint"
         adapt_dur|adapt_token_num: used in adaptive mode, see _work_adapt_batch_index
         distributed: distributed or not
+        drop_last: drop the remainder batches in distributed mode or not
     """
 
     def __init__(self,
@@ -207,7 +230,8 @@ class BatchSampler(dat.Sampler):
                  adapt_dur: float = 800,
                  adapt_token_num: int = 150,
                  min_batch_size: int = 4,
-                 distributed: bool = False) -> None:
+                 distributed: bool = False,
+                 drop_last: bool = True) -> None:
         if batch_mode not in ["adaptive", "constraint"]:
             raise ValueError(f"Unsupported batch mode: {batch_mode}")
         if batch_mode == "adaptive":
@@ -220,9 +244,11 @@ class BatchSampler(dat.Sampler):
         self.epoch = 0
         self.batches = batches
         self.shuffle = shuffle
-        self.world_size = dist.world_size() if distributed else 1
         self.distributed = distributed
-        self.num_batches = len(batches) // self.world_size
+        self.drop_last = drop_last
+        self.num_batches = num_rank_batches(len(batches),
+                                            distributed=distributed,
+                                            drop_last=drop_last)
 
     def _work_const_batch_index(self, dataset: dat.Dataset,
                                 max_batch_size: int) -> List[Tuple[int, int]]:
@@ -276,10 +302,11 @@ class BatchSampler(dat.Sampler):
         return idx_boundary
 
     def __iter__(self):
-        indices = derive_indices(self.num_batches,
+        indices = derive_indices(len(self.batches),
                                  seed=self.epoch,
                                  shuffle=self.shuffle,
-                                 distributed=self.distributed)
+                                 distributed=self.distributed,
+                                 drop_last=self.drop_last)
         subset = [self.batches[i] for i in indices]
         return iter([list(range(beg, end)) for beg, end in subset])
 
@@ -324,11 +351,19 @@ class AsrDataLoader(dat.DataLoader):
                                batch_mode=batch_mode,
                                distributed=distributed,
                                min_batch_size=min_batch_size,
-                               adapt_token_num=adapt_token_num)
-        super(AsrDataLoader, self).__init__(dataset,
-                                            collate_fn=collate_fn,
-                                            num_workers=num_workers,
-                                            batch_sampler=sampler)
+                               adapt_token_num=adapt_token_num,
+                               # keep all the batches for evaluation, the
+                               # statistics are reduced over the ranks
+                               drop_last=shuffle)
+        # keep the workers alive across epochs and collate into the pinned
+        # memory, so the trainer can copy the egs to GPU asynchronously
+        super(AsrDataLoader, self).__init__(
+            dataset,
+            collate_fn=collate_fn,
+            num_workers=num_workers,
+            batch_sampler=sampler,
+            pin_memory=th.cuda.is_available(),
+            persistent_workers=num_workers > 0)
 
     def set_epoch(self, epoch: int) -> NoReturn:
         self.batch_sampler.set_epoch(epoch)
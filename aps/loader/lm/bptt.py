@@ -12,7 +12,7 @@ import aps.distributed as dist
 
 from typing import Optional, Iterable, Iterator, Dict, List, NoReturn
 from aps.loader.lm.utils import filter_utts, concat_data
-from aps.loader.am.utils import derive_indices
+from aps.loader.am.utils import derive_indices, num_rank_batches
 from aps.loader.lm.utt import Dataset
 from aps.utils import get_logger
 from aps.libs import ApsRegisters
@@ -66,6 +66,7 @@ class SequenceSampler(dat.Sampler):
         shuffle: shuffle batches or not
         distributed: in distributed mode or not
         {min|max}_token_num: boundary of the token length
+        drop_last: drop the remainder utterances in distributed mode or not
     """
 
     def __init__(self,
@@ -73,12 +74,11 @@ class SequenceSampler(dat.Sampler):
                  shuffle: bool = False,
                  distributed: bool = False,
                  min_token_num: int = 2,
-                 max_token_num: int = 2000) -> None:
+                 max_token_num: int = 2000,
+                 drop_last: bool = True) -> None:
         if distributed:
-            self.world_size = dist.world_size()
             self.header = f"SequenceSampler (rank {dist.rank()})"
         else:
-            self.world_size = 1
             self.header = "SequenceSampler"
         logger.info(f"{self.header}: filtering utterances ...")
         self.indices = filter_utts(dataset,
@@ -89,13 +89,17 @@ class SequenceSampler(dat.Sampler):
         self.batches = list(range(kept_utt_num))
         self.shuffle = shuffle
         self.distributed = distributed
-        self.num_batches = kept_utt_num // self.world_size
+        self.drop_last = drop_last
+        self.num_batches = num_rank_batches(kept_utt_num,
+                                            distributed=distributed,
+                                            drop_last=drop_last)
 
     def __iter__(self) -> Iterator[List[int]]:
-        indices = derive_indices(self.num_batches,
+        indices = derive_indices(len(self.batches),
                                  seed=self.epoch,
                                  shuffle=self.shuffle,
-                                 distributed=self.distributed)
+                                 distributed=self.distributed,
+                                 drop_last=self.drop_last)
         indices = [self.indices[i] for i in indices]
         return iter(indices)
 
@@ -132,7 +136,8 @@ class BpttDataloader(object):
                                        shuffle=shuffle,
                                        distributed=distributed,
                                        min_token_num=min_token_num,
-                                       max_token_num=max_token_num)
+                                       max_token_num=max_token_num,
+                                       drop_last=shuffle)
 
     def __iter__(self) -> Iterator[Dict]:
         # B x N
@@ -15,7 +15,7 @@ import aps.distributed as dist
 from torch.nn.utils.rnn import pad_sequence
 from typing import NoReturn, List, Dict, Optional, Iterator, Iterable
 from aps.loader.lm.utils import filter_utts
-from aps.loader.am.utils import derive_indices
+from aps.loader.am.utils import derive_indices, num_rank_batches
 from aps.utils import get_logger
 from aps.const import IGNORE_ID, UNK_TOKEN
 from aps.libs import ApsRegisters
@@ -128,6 +128,7 @@ class BatchSampler(dat.Sampler):
         min_batch_size: minimum value of #batch_size
         adapt_token_num: used for #batch_size reduction
         chunk_size_for_sort: we perform sort in each chunk (for large LM corpus)
+        drop_last: drop the remainder batches in distributed mode or not
     """
 
     def __init__(self,
@@ -139,12 +140,11 @@ class BatchSampler(dat.Sampler):
                  max_token_num: int = 2000,
                  min_batch_size: int = 8,
                  adapt_token_num: int = 400,
-                 chunk_size_for_sort: int = 10000) -> None:
+                 chunk_size_for_sort: int = 10000,
+                 drop_last: bool = True) -> None:
         if distributed:
-            self.world_size = dist.world_size()
             self.header = f"BatchSampler (rank {dist.rank()})"
         else:
-            self.world_size = 1
             self.header = "BatchSampler"
         batches = []
         chunk_size = chunk_size_for_sort
@@ -172,7 +172,10 @@ class BatchSampler(dat.Sampler):
         self.batches = batches
         self.shuffle = shuffle
         self.distributed = distributed
-        self.num_batches = len(batches) // self.world_size
+        self.drop_last = drop_last
+        self.num_batches = num_rank_batches(len(batches),
+                                            distributed=distributed,
+                                            drop_last=drop_last)
 
     def _sort_indices(self,
                       dataset: dat.Dataset,
@@ -197,10 +200,11 @@ class BatchSampler(dat.Sampler):
         return batches
 
     def __iter__(self) -> Iterator[List[int]]:
-        indices = derive_indices(self.num_batches,
+        indices = derive_indices(len(self.batches),
                                  seed=self.epoch,
                                  shuffle=self.shuffle,
-                                 distributed=self.distributed)
+                                 distributed=self.distributed,
+                                 drop_last=self.drop_last)
         indices = [self.batches[i] for i in indices]
         return iter(indices)
 
@@ -252,11 +256,16 @@ class UttDataLoader(dat.DataLoader):
                                max_token_num=max_token_num,
                                min_batch_size=min_batch_size,
                                adapt_token_num=adapt_token_num,
-                               chunk_size_for_sort=chunk_size_for_sort)
-        super(UttDataLoader, self).__init__(dataset,
-                                            batch_sampler=sampler,
-                                            num_workers=num_workers,
-                                            collate_fn=self.egs_collate)
+                               chunk_size_for_sort=chunk_size_for_sort,
+                               drop_last=shuffle)
+        # see AsrDataLoader
+        super(UttDataLoader, self).__init__(
+            dataset,
+            batch_sampler=sampler,
+            num_workers=num_workers,
+            collate_fn=self.egs_collate,
+            pin_memory=th.cuda.is_available(),
+            persistent_workers=num_workers > 0)
 
     def egs_collate(self, egs):
         sos_egs = [th.as_tensor([self.sos] + eg) for eg in egs]
@@ -288,7 +288,8 @@ class WaveChunkDataLoader(object):
                                         sampler=self.sampler,
                                         shuffle=(train and
                                                  self.sampler is None),
-                                        collate_fn=self._collate)
+                                        collate_fn=self._collate,
+                                        persistent_workers=num_workers > 0)
 
     def _collate(self, batch):
         chunk = []
@@ -3,15 +3,20 @@
 import argparse
 
 
+_TRUE_STRINGS = frozenset(["true", "y", "yes", "1"])
+_FALSE_STRINGS = frozenset(["false", "n", "no", "0"])
+
+
 class StrToBoolAction(argparse.Action):
     """
     Since don't like argparse.store_true or argparse.store_false
     """
 
     def __call__(self, parser, namespace, values, option_string=None):
-        if values.lower() in ["true", "y", "yes", "1"]:
+        value = values.lower()
+        if value in _TRUE_STRINGS:
             bool_value = True
-        elif values in ["false", "n", "no", "0"]:
+        elif value in _FALSE_STRINGS:
             bool_value = False
         else:
             raise ValueError(f"Unknown value {values} for --{self.dest}")
@@ -1,19 +1,26 @@
 # Copyright 2019 Jian Wu
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
+import io
+import copy
 import math
+import pickle
 import warnings
 
 from pathlib import Path
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 import torch as th
 from typing import Optional, Dict, List, Union, Tuple, NoReturn, Iterable
+from typing import Any, Callable
 from aps.trainer.ss import SsScheduler
 from aps.trainer.lr import LrScheduler
 from aps.utils import load_obj, get_logger, SimpleTimer
 from aps.task import Task
 
+import aps.distributed as dist
+
 try:
     from torch.utils.tensorboard import SummaryWriter
     tensorboard_available = True
@@ -21,6 +28,61 @@ except ImportError:
     tensorboard_available = False
 
 
+def stage_obj(obj: Any) -> Any:
+    """
+    Copy the tensor object in obj to (pinned) CPU memory, so that it can be
+    serialized in the background while the training goes on
+    Args:
+        obj: Arbitrary object (e.g., state_dict)
+    """
+    if isinstance(obj, th.Tensor):
+        if obj.is_cuda:
+            staged = th.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+            return staged.copy_(obj.detach(), non_blocking=True)
+        return obj.detach().clone()
+    elif isinstance(obj, dict):
+        # NOTE: shallow copy keeps the class & _metadata of the state_dict
+        staged = copy.copy(obj)
+        for key in staged:
+            staged[key] = stage_obj(staged[key])
+        return staged
+    elif isinstance(obj, list):
+        return [stage_obj(val) for val in obj]
+    else:
+        return obj
+
+
+def fetch_stats(stats: Dict) -> Dict:
+    """
+    Return a copy of stats with the scalar tensors copied to host as python
+    numbers, all at once (only one device sync)
+    """
+    tensor_keys = [
+        key for key, value in stats.items() if isinstance(value, th.Tensor)
+    ]
+    if not tensor_keys:
+        return stats
+    values = th.stack([
+        stats[key].detach().reshape(()).float() for key in tensor_keys
+    ]).tolist()
+    return {**stats, **dict(zip(tensor_keys, values))}
+
+
+def save_obj(obj: Any, path: Path) -> NoReturn:
+    """
+    Serialize obj to the memory buffer and write it out at once (instead of
+    many small writes from the pickle stream)
+    """
+    buf = io.BytesIO()
+    # the tensor storages are written as raw records in the zip format, use
+    # the highest pickle protocol for the rest
+    th.save(obj,
+            buf,
+            pickle_protocol=pickle.HIGHEST_PROTOCOL,
+            _use_new_zipfile_serialization=True)
+    path.write_bytes(buf.getbuffer())
+
+
 class WeightNoiseAdder(object):
     """
     Add gaussian noise to the network weight
@@ -35,20 +97,41 @@ class WeightNoiseAdder(object):
             raise ValueError(f"WeightNoiseAdder: std must > 0, got {std}")
         self.std = std
         self.beg, self.step, self.end = cfg
+        self.groups = None
+
+    def _group_params(self, nnet: th.nn.Module) -> List[Tuple]:
+        """
+        Group the trainable parameters by (device, dtype), only done once as
+        the parameter set doesn't change during training
+        """
+        if self.groups is None:
+            groups = defaultdict(list)
+            for p in nnet.parameters():
+                if p.requires_grad:
+                    groups[(p.device, p.dtype)].append(p.data)
+            self.groups = [(device, dtype, params,
+                            [p.numel() for p in params])
+                           for (device, dtype), params in groups.items()]
+        return self.groups
 
     def __call__(self, nnet: th.nn.Module, step: int) -> NoReturn:
         if step < self.beg:
             return
         if self.end > 0 and step > self.end:
             return
-        if step - self.beg % self.step:
+        if (step - self.beg) % self.step:
             return
-        for p in nnet.parameters():
-            if p.requires_grad:
-                p.data += th.normal(0,
-                                    self.std,
-                                    size=p.data.shape,
-                                    device=p.data.device)
+        for device, dtype, params, sizes in self._group_params(nnet):
+            # one RNG call for the group
+            noise = th.randn(sum(sizes), device=device, dtype=dtype)
+            noise = [
+                n.view_as(p) for n, p in zip(noise.split(sizes), params)
+            ]
+            if hasattr(th, "_foreach_add_"):
+                th._foreach_add_(params, noise, alpha=self.std)
+            else:
+                for p, n in zip(params, noise):
+                    p.add_(n, alpha=self.std)
 
 
 class ParameterAverager(object):
@@ -64,6 +147,9 @@ class ParameterAverager(object):
         self.averaged = OrderedDict()
 
     def add(self, state_dict):
+        # keep the module versions, which load_state_dict(...) relies on
+        if not self.count and hasattr(state_dict, "_metadata"):
+            self.averaged._metadata = copy.deepcopy(state_dict._metadata)
         for key in state_dict.keys():
             param = state_dict[key]
             if key not in self.averaged:
@@ -90,6 +176,7 @@ class ProgressReporter(object):
         rank: rank value (for distributed training only)
         tensorboard: use tensorboard or not
         reduction_tag: #utt|#tok|none, how we compute the averaged numbers
+        verbose_ranks: ranks that log the training progress periodically
     """
 
     def __init__(self,
@@ -98,7 +185,8 @@ class ProgressReporter(object):
                  rank: Optional[int] = None,
                  period: int = 100,
                  tensorboard: bool = True,
-                 reduction_tag: str = "none") -> None:
+                 reduction_tag: str = "none",
+                 verbose_ranks: List[int] = [0]) -> None:
         # NOTE on reduction_tag:
         #   1) for asr tasks we use #tok (token level)
         #   2) for sse tasks we use $utt (utterance level)
@@ -114,7 +202,9 @@ class ProgressReporter(object):
             logger_loc = (checkpoint / f"trainer.rank.{rank}.log").as_posix()
             self.header = f"Rank {rank}"
 
-        self.logger = get_logger(logger_loc, file=True)
+        self.verbose = rank is None or rank in verbose_ranks
+        # the logging file is written out when report(...)
+        self.logger = get_logger(logger_loc, file=True, buffer_size=256)
         # only for rank-0
         if tensorboard and rank in [0, None]:
             if not tensorboard_available:
@@ -125,6 +215,7 @@ class ProgressReporter(object):
         else:
             self.board_writer = None
         self.metrics = metrics
+        self.mode = "train"
         self.reset()
 
     def log(self, sstr: str) -> NoReturn:
@@ -153,7 +244,16 @@ class ProgressReporter(object):
         """
         Clear the status
         """
-        self.stats = defaultdict(list)
+        # running sums (weighted by the reduction_tag) of the whole epoch
+        self.count = defaultdict(int)
+        self.total = defaultdict(int)
+        self.weight = defaultdict(int)
+        # (value, weight) of the last #period batches
+        self.window = defaultdict(lambda: deque(maxlen=self.period))
+        # the last value of each item
+        self.last = {}
+        # loss of each batch (only logged in eval mode)
+        self.losses = []
         self.timer = SimpleTimer()
 
     def update(self,
@@ -165,9 +265,7 @@ class ProgressReporter(object):
         if dict_obj is None:
             return
         if keys is None:
-            for key, value in dict_obj.items():
-                if isinstance(value, th.Tensor):
-                    value = value.item()
+            for key, value in fetch_stats(dict_obj).items():
                 self.add(key, value)
         else:
             for key in keys:
@@ -178,39 +276,48 @@ class ProgressReporter(object):
         """
         Track one recording item
         """
-        self.stats[key].append(value)
-        N = len(self.stats[key])
-        if not N % self.period:
+        # metrics are weighted by the last tracked reduction_tag (#utt|#tok),
+        # which is updated before the metrics of the same batch
+        if key[0] == "#" or key == "rate":
+            weight = 1
+        else:
+            weight = self.last.get(self.reduction_tag, 1)
+        self.count[key] += 1
+        self.total[key] += value * weight
+        self.weight[key] += weight
+        self.window[key].append((value, weight))
+        self.last[key] = value
+        if key == "loss" and self.mode == "valid":
+            self.losses.append(value)
+        N = self.count[key]
+        if self.verbose and not N % self.period:
             if key == "rate":
                 # current learning rate
-                cur = self.stats[key][-1]
-                self.log(f"Processed {N:.2e} batches ({key} = {cur:.3e}) ...")
+                self.log(
+                    f"Processed {N:.2e} batches ({key} = {value:.3e}) ...")
             elif key[0] == "#":
                 # averged token/utterance numbers in the past
-                cur = sum(self.stats[key][-self.period:]) // self.period
+                cur = sum(v for v, _ in self.window[key]) // self.period
                 self.log(f"Processed {N:.2e} batches ({key} = {cur:d}) ...")
             else:
-                avg = self._report_metric(key, period=self.period)
+                avg = self._report_metric(key, window=True)
                 self.log(f"Processed {N:.2e} batches ({key} = {avg:+.2f}) ...")
 
-    def _report_metric(self, key: str, period: int = 0):
+    def _report_metric(self, key: str, window: bool = False):
         """
-        Return the averaged tracked metric
+        Return the averaged tracked metric (over the last #period batches if
+        window is true, else the whole epoch)
         """
-        nors = self.stats[key][-period:]
-        # try to get denominator
-        if self.reduction_tag in self.stats:
-            dens = self.stats[self.reduction_tag][-period:]
-        else:
-            dens = None
+        if self.reduction_tag not in self.count:
             warnings.warn(f"{self.reduction_tag} not found in the tracked " +
                           "statistics, using simple average")
-        if dens is None:
-            # simple average
-            avg = sum(nors) / len(nors)
+        if window:
+            total = sum(v * w for v, w in self.window[key])
+            weight = sum(w for _, w in self.window[key])
         else:
-            # weight sum and average
-            avg = sum(nors[i] * d for i, d in enumerate(dens)) / sum(dens)
+            total, weight = self.total[key], self.weight[key]
+        # weight sum and average (simple average if weight == 1)
+        avg = total / weight
         if key == "accu":
             avg *= 100
         if key == "@ppl":
@@ -223,7 +330,7 @@ class ProgressReporter(object):
         """
         reports = {}
         for metric in self.metrics:
-            if metric not in self.stats:
+            if metric not in self.count:
                 raise RuntimeError(
                     f"Metric {metric} is not tracked by the reporter")
             reports[metric] = self._report_metric(metric)
@@ -233,11 +340,11 @@ class ProgressReporter(object):
         """
         Return the reports and log messages
         """
-        N = len(self.stats["loss"])
+        N = self.count["loss"]
         if self.mode == "valid":
-            sstr = ",".join(
-                map(lambda f: "{:.2f}".format(f), self.stats["loss"]))
-            self.log(f"Loss on {N:d} batches: {sstr}")
+            # losses of the batches on this rank
+            sstr = ",".join(map(lambda f: "{:.2f}".format(f), self.losses))
+            self.log(f"Loss on {len(self.losses):d} batches: {sstr}")
 
         if N == 0:
             raise RuntimeError("No statistics to report")
@@ -246,15 +353,49 @@ class ProgressReporter(object):
         # Write tensorboard if needed
         if self.board_writer:
             for name, value in reports.items():
-                self.board_writer.add_scalar(f"stats/{self.mode}", name, value)
+                self.board_writer.add_scalar(f"{self.mode}/{name}",
+                                             value,
+                                             global_step=epoch)
+            # write to disk once per epoch
+            self.board_writer.flush()
         cost = self.timer.elapsed()
 
         header = "/".join(self.metrics)
         values = "/".join([f"{reports[metric]:.4f}" for metric in self.metrics])
         logstr = (f"Epoch {epoch:02d}/{self.mode}: {header}(time/#batch, " +
                   f"lr={lr:.3e}) = {values}({cost:.2f}m/{N:d})")
+        self.flush()
         return reports, logstr
 
+    def all_reduce(self, device: th.device) -> NoReturn:
+        """
+        Sum up the statistics tracked on each rank (used when the validation
+        set is split across the ranks)
+        """
+        # same keys on every rank, even if one of them saw no batches
+        keys = sorted(set(self.metrics) | {"loss", self.reduction_tag})
+        stats = [[self.total.get(k, 0),
+                  self.weight.get(k, 0),
+                  self.count.get(k, 0)] for k in keys]
+        stats = th.tensor(stats, dtype=th.float64, device=device)
+        stats = dist.all_reduce_sum(stats)
+        for key, (total, weight, count) in zip(keys, stats.tolist()):
+            if count == 0:
+                # not tracked on any rank
+                for obj in [self.total, self.weight, self.count]:
+                    obj.pop(key, None)
+            else:
+                self.total[key] = total
+                self.weight[key] = weight
+                self.count[key] = int(round(count))
+
+    def flush(self) -> NoReturn:
+        """
+        Write out the buffered logs
+        """
+        for handler in self.logger.handlers:
+            handler.flush()
+
 
 class ErrorDetector(object):
     """
@@ -396,6 +537,8 @@ class Trainer(object):
         report_metrics: metrics to be tracked during training
         reduction_tag: used in ProgressReporter
         stop_on_errors: stop training if #stop_on_errors consecutive errors exist
+        compile_mode: compile the network with torch.compile (torch >= 2.2)
+                      using the given mode, e.g., default|reduce-overhead
     """
 
     def __init__(self,
@@ -426,6 +569,7 @@ class Trainer(object):
                  report_metrics: List[str] = ["loss"],
                  reduction_tag: str = "none",
                  stop_on_errors: int = 32,
+                 compile_mode: str = "none",
                  **kwargs) -> None:
         if not isinstance(task, Task):
             raise TypeError(
@@ -439,11 +583,16 @@ class Trainer(object):
         if rank is not None and rank < 0:
             raise ValueError(f"Got invalid rank value: {rank}")
 
-        self.default_device = th.device(f"cuda:{device_id:d}")
+        self.default_device = th.device("cuda", device_id)
         th.cuda.set_device(self.default_device)
+        # side stream to copy egs to GPU (see prefetch_egs)
+        self.copy_stream = th.cuda.Stream(device=self.default_device)
 
         self.rank = rank
         self.checkpoint = Path(checkpoint)
+        # save checkpoints in the background (one at a time)
+        self.save_executor = ThreadPoolExecutor(max_workers=1)
+        self.save_future = None
         # if exist, resume training
         last_checkpoint = self.checkpoint / "last.pt.tar"
         if last_checkpoint.exists():
@@ -480,6 +629,8 @@ class Trainer(object):
         self.detector = ErrorDetector(stop_on_errors)
         self.task = task
         self.task.to(self.default_device)
+        if compile_mode != "none":
+            self.compile_nnet(compile_mode)
         if self.rank in [0, None]:
             self.reporter.log(f"Model summary:\n{task.nnet}")
 
@@ -503,6 +654,8 @@ class Trainer(object):
                                                optimizer_kwargs,
                                                state=optimizer_dict)
         self.optimizer.zero_grad()
+        # trainable parameters (cached for gradient clipping)
+        self.params = [p for p in self.task.parameters() if p.requires_grad]
 
         # make lr scheduler
         if lr_scheduler == "reduce_lr":
@@ -556,6 +709,18 @@ class Trainer(object):
             self.reporter.log("Save model states in epoch.#epoch.pt.tar " +
                               f"(interval = {save_interval})")
 
+    def compile_nnet(self, mode: str) -> NoReturn:
+        """
+        Compile the network in-place, which keeps the parameter names (and
+        the checkpoint format) unchanged
+        """
+        if not hasattr(th.nn.Module, "compile"):
+            warnings.warn("nn.Module.compile is not supported in torch " +
+                          f"{th.__version__}, skip compiling the network")
+            return
+        self.task.nnet.compile(mode=mode)
+        self.reporter.log(f"Compile the network with mode = {mode}")
+
     def create_optimizer(self,
                          optimizer: str,
                          kwargs: Dict,
@@ -636,14 +801,18 @@ class Trainer(object):
         raise NotImplementedError
 
     def save_checkpoint(self,
-                        states: Dict,
+                        states: Union[Dict, Callable[[bool], Dict]],
                         tag: str = "best",
                         enable_subroutine: bool = True,
                         keep_optimizer: bool = True) -> NoReturn:
         """
-        Save checkpoint (epoch, model, optimizer, ...)
+        Save checkpoint (epoch, model, optimizer, ...). The states could be
+        a function (called with keep_optimizer) which is only evaluated when
+        saving, to avoid collecting optimizer states that are not needed
         """
         if self.rank in [0, None]:
+            if callable(states):
+                states = states(keep_optimizer)
             if enable_subroutine:
                 cpt = self.model_states()
                 cpt.update(states)
@@ -652,10 +821,27 @@ class Trainer(object):
             cpt_name = f"{tag}.pt.tar"
             if not keep_optimizer and "optimizer_state" in cpt:
                 _ = cpt.pop("optimizer_state")
-            th.save(cpt, self.checkpoint / cpt_name)
+            # wait for the previous one
+            self.wait_checkpoint()
+            # the states are updated in-place after we return, so copy them
+            # to CPU memory first, then serialize them in the background
+            cpt = stage_obj(cpt)
+            if th.cuda.is_available():
+                th.cuda.synchronize()
+            self.save_future = self.save_executor.submit(
+                save_obj, cpt, self.checkpoint / cpt_name)
             self.reporter.log(
                 f"Save checkpoint ==> {self.checkpoint / cpt_name}")
 
+    def wait_checkpoint(self) -> NoReturn:
+        """
+        Wait until the checkpoint being saved in the background is done
+        """
+        if self.save_future is not None:
+            # raise here if failed
+            self.save_future.result()
+            self.save_future = None
+
     def average_checkpoints(self) -> NoReturn:
         """
         Average checkpoint over no improvement epochs
@@ -665,6 +851,8 @@ class Trainer(object):
         if self.rank not in [0, None]:
             return
         self.reporter.log("Average checkpoints ...")
+        # make sure all the epoch.*.pt.tar are on the disk
+        self.wait_checkpoint()
         averager = ParameterAverager()
         beg_epoch = self.cur_epoch - self.average_checkpoint + 1
         for i in range(beg_epoch, self.cur_epoch + 1):
@@ -715,7 +903,7 @@ class Trainer(object):
         self.task.train()
         self.reporter.train()
         self.detector.reset()
-        for egs in data_loader:
+        for egs in self.prefetch_egs(data_loader):
             # load to gpu
             egs = self.prep_egs(egs)
             # make one training step
@@ -738,13 +926,16 @@ class Trainer(object):
         self.reporter.eval()
 
         with th.no_grad():
-            for egs in data_loader:
+            for egs in self.prefetch_egs(data_loader):
                 # load to gpu
                 egs = self.prep_egs(egs)
                 stats = self.task(egs)
                 # update statistics
                 self.reporter.update(egs, ["#utt", "#tok"])
                 self.reporter.update(stats)
+        # each rank only runs on its part of the validation set
+        if self.rank is not None:
+            self.reporter.all_reduce(self.default_device)
 
     def stop_detect(self, dev_loader: Iterable[Dict], lr: float) -> bool:
         """
@@ -766,15 +957,26 @@ class Trainer(object):
         status = {
             "step": self.cur_step,
             "epoch": self.cur_epoch,
-            "num_parameters": self.num_params,
-            "detector_state": self.stop_detector.state_dict(),
-            "optimizer_state": self.optimizer.state_dict(),
-            "lr_scheduler_state": self.lr_scheduler.state_dict()
+            "num_parameters": self.num_params
         }
         status.update(reports)
+
+        def checkpoint_states(keep_optimizer: bool = True) -> Dict:
+            """
+            Collect the training states only when saving
+            """
+            states = {
+                "detector_state": self.stop_detector.state_dict(),
+                "lr_scheduler_state": self.lr_scheduler.state_dict(),
+                **status
+            }
+            if keep_optimizer:
+                states["optimizer_state"] = self.optimizer.state_dict()
+            return states
+
         if better:
             # save best checkpoint
-            self.save_checkpoint(status, tag="best")
+            self.save_checkpoint(checkpoint_states, tag="best")
         else:
             no_impr = self.stop_detector.no_impr
             logstr += f" | no impr: {no_impr:d}, "
@@ -787,9 +989,9 @@ class Trainer(object):
         if self.ss_scheduler:
             self.ssr = self.ss_scheduler.step(self.cur_epoch, reports["accu"])
         # save last checkpoint
-        self.save_checkpoint(status, tag="last")
+        self.save_checkpoint(checkpoint_states, tag="last")
         if self.save_interval > 0 and self.cur_epoch % self.save_interval == 0:
-            self.save_checkpoint(status,
+            self.save_checkpoint(checkpoint_states,
                                  tag=f"epoch.{self.cur_epoch}",
                                  keep_optimizer=False)
         # early stop
@@ -799,11 +1001,41 @@ class Trainer(object):
             return True
         return False
 
+    def prefetch_egs(self, data_loader: Iterable[Dict]) -> Iterable[Dict]:
+        """
+        Iterate the data loader and copy the next egs to GPU on a side stream,
+        overlapped with the training step of the current one
+        """
+
+        def record_stream(obj, stream):
+            if isinstance(obj, dict):
+                for val in obj.values():
+                    record_stream(val, stream)
+            elif isinstance(obj, list):
+                for val in obj:
+                    record_stream(val, stream)
+            elif isinstance(obj, th.Tensor) and obj.is_cuda:
+                # tell allocator that it's used by another stream
+                obj.record_stream(stream)
+
+        cur_egs = None
+        for egs in data_loader:
+            with th.cuda.stream(self.copy_stream):
+                egs = load_obj(egs, self.default_device, non_blocking=True)
+            if cur_egs is not None:
+                yield cur_egs
+            main_stream = th.cuda.current_stream()
+            main_stream.wait_stream(self.copy_stream)
+            record_stream(egs, main_stream)
+            cur_egs = egs
+        if cur_egs is not None:
+            yield cur_egs
+
     def prep_egs(self, egs: Dict) -> Dict:
         """
         Prepare training egs
         """
-        egs = load_obj(egs, self.default_device)
+        egs = load_obj(egs, self.default_device, non_blocking=True)
         # use ssr = 0 when in eval mode
         if self.ss_scheduler:
             egs["ssr"] = self.ssr if self.task.training else 0
@@ -859,7 +1091,7 @@ class Trainer(object):
         stop = False
         while True:
             # trained on several batches
-            for egs in trn_loader:
+            for egs in self.prefetch_egs(trn_loader):
                 # enable train mode
                 if self.cur_step % eval_interval == 0:
                     self.task.train()
@@ -919,7 +1151,9 @@ class Trainer(object):
                                            dev_loader,
                                            num_epochs=num_epochs)
         self.average_checkpoints()
+        self.wait_checkpoint()
         hours = timer.elapsed() / 60
         self.reporter.log(
             f"Training for {done_epoch:d}/{num_epochs:d} epochs " +
             f"done (cost {hours:.2f} hours)")
+        self.reporter.flush()
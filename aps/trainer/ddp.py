@@ -2,6 +2,7 @@
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
 import math
+import contextlib
 
 import torch as th
 from torch.nn.utils import clip_grad_norm_
@@ -9,7 +10,7 @@ from torch.nn.parallel import DistributedDataParallel
 from typing import Optional, Dict, List, Union, NoReturn
 from pathlib import Path
 
-from aps.trainer.base import Trainer
+from aps.trainer.base import Trainer, fetch_stats
 from aps.libs import ApsRegisters
 from aps.const import OOM_STRING
 
@@ -20,6 +21,12 @@ import aps.distributed as dist
 class DdpTrainer(Trainer):
     """
     The PyTorch distributed data parallel (DDP) Trainer
+    Args (the others see aps.trainer.base.Trainer):
+        bucket_cap_mb: size of the DDP gradient buckets
+        gradient_as_bucket_view: gradients are views of the DDP buckets
+        amp_dtype: none|fp16|bf16, run forward in mixed precision using
+                   native AMP (fp16 with gradient scaling, bf16 needs
+                   torch >= 1.10)
     """
 
     def __init__(self,
@@ -50,7 +57,13 @@ class DdpTrainer(Trainer):
                  report_metrics: List[str] = ["loss"],
                  reduction_tag: str = "none",
                  stop_on_errors: int = 10,
+                 bucket_cap_mb: int = 25,
+                 gradient_as_bucket_view: bool = True,
+                 compile_mode: str = "none",
+                 amp_dtype: str = "none",
                  **kwargs) -> None:
+        if amp_dtype not in ["none", "fp16", "bf16"]:
+            raise ValueError(f"Unsupported amp_dtype: {amp_dtype}")
         super(DdpTrainer,
               self).__init__(task,
                              rank=rank,
@@ -78,15 +91,39 @@ class DdpTrainer(Trainer):
                              average_checkpoint=average_checkpoint,
                              report_metrics=report_metrics,
                              reduction_tag=reduction_tag,
-                             stop_on_errors=stop_on_errors)
+                             stop_on_errors=stop_on_errors,
+                             compile_mode=compile_mode)
         if dist.get_backend() not in ["torch", "none"]:
             raise ValueError(
                 "DdpTrainer should use torch/none as distributed backend")
-        self.setup_distributed(device_id)
+        self.setup_distributed(device_id,
+                               bucket_cap_mb=bucket_cap_mb,
+                               gradient_as_bucket_view=gradient_as_bucket_view)
+        self.setup_amp(amp_dtype)
 
-    def setup_distributed(self, device_id: int) -> NoReturn:
+    def setup_amp(self, amp_dtype: str) -> NoReturn:
+        """
+        Setup native automatic mixed precision (AMP) training
+        """
+        self.amp_kwargs = {"enabled": amp_dtype != "none"}
+        if amp_dtype == "bf16":
+            self.amp_kwargs["dtype"] = th.bfloat16
+        # loss scaling is only needed for fp16 (no-op if disabled)
+        self.scaler = th.amp.GradScaler("cuda", enabled=amp_dtype == "fp16")
+        if amp_dtype != "none":
+            self.reporter.log(f"AMP: using mixed precision with {amp_dtype}")
+
+    def setup_distributed(self,
+                          device_id: int,
+                          bucket_cap_mb: int = 25,
+                          gradient_as_bucket_view: bool = True) -> NoReturn:
         """
         Setup environment for distributed training
+        Args:
+            bucket_cap_mb: size of the gradient buckets (all-reduced while
+                           the backward is still running)
+            gradient_as_bucket_view: let the gradients be the views of the
+                                     buckets to save the copies between them
         """
         if self.rank is not None:
             self.distributed = True
@@ -94,9 +131,13 @@ class DdpTrainer(Trainer):
                 f"DDP: using distributed data parallel (DDP), rank={self.rank}, "
                 + f"world_size={dist.world_size()}")
             # find_unused_parameters=True helps us report potential code errors
-            self.task = DistributedDataParallel(self.task,
-                                                device_ids=[device_id],
-                                                find_unused_parameters=False)
+            self.task = DistributedDataParallel(
+                self.task,
+                device_ids=[device_id],
+                output_device=device_id,
+                find_unused_parameters=False,
+                bucket_cap_mb=bucket_cap_mb,
+                gradient_as_bucket_view=gradient_as_bucket_view)
         else:
             self.distributed = False
 
@@ -114,49 +155,51 @@ class DdpTrainer(Trainer):
             self.weight_noise_adder(self.task, self.cur_step)
 
         is_backward_step = (self.cur_step + 1) % self.acmu_gradient == 0
-        # handle OOM during forward
-        try:
-            if self.distributed and not is_backward_step:
-                with self.task.no_sync():
-                    stats = self.task(egs)
-            else:
-                stats = self.task(egs)
-        except RuntimeError as rt_err:
-            if OOM_STRING in str(rt_err):
-                th.cuda.empty_cache()
-                self.reporter.log("Get CUDA OOM during forward, skip...")
-                return False
-            else:
-                raise rt_err
-
-        # use all reduce to check loss
-        if self.distributed and is_backward_step:
-            loss = dist.all_reduce(stats["loss"].clone()).item()
+        # skip gradient all-reduce (both forward & backward) for the
+        # accumulation steps, only sync at the last one
+        if self.distributed and not is_backward_step:
+            sync_context = self.task.no_sync()
         else:
-            loss = stats["loss"].item()
-
-        # backward if not nan/inf
-        if math.isfinite(loss):
-            (stats["loss"] / self.acmu_gradient).backward()
-        else:
-            self.reporter.log(f"Invalid loss {loss:.3f}, skip...")
-            return False
+            sync_context = contextlib.nullcontext()
+        with sync_context:
+            # handle OOM during forward
+            try:
+                with th.autocast("cuda", **self.amp_kwargs):
+                    stats = self.task(egs)
+            except RuntimeError as rt_err:
+                if OOM_STRING in str(rt_err):
+                    th.cuda.empty_cache()
+                    self.reporter.log("Get CUDA OOM during forward, skip...")
+                    return False
+                else:
+                    raise rt_err
+
+            # NOTE: no loss.item() here (a device sync per step), the nan/inf
+            #       loss is detected from the gradient norm below
+            self.scaler.scale(stats["loss"] / self.acmu_gradient).backward()
 
         # if not backward step, return
         if not is_backward_step:
             return True
 
-        # clip gradient after backward
-        norm = -1
-        if self.clip_gradient > 0:
-            norm = clip_grad_norm_(self.task.parameters(), self.clip_gradient)
+        # unscale the fp16 gradients before clipping (no-op if disabled)
+        self.scaler.unscale_(self.optimizer)
+        # clip gradient after backward (also get the norm to check nan/inf
+        # when not clipping). As the gradients are all-reduced, all the ranks
+        # make the same decision
+        max_norm = self.clip_gradient if self.clip_gradient > 0 else math.inf
+        stats["norm"] = clip_grad_norm_(self.params, max_norm)
+        # the only device sync of the step: fetch the gradient norm together
+        # with the tracked statistics
+        stats = fetch_stats(stats)
+        norm = stats["norm"] if self.clip_gradient > 0 else stats.pop("norm")
 
         # step optimizer and update statistics
         if math.isfinite(norm):
-            self.optimizer.step()
-            self.optimizer.zero_grad()
-            if norm != -1:
-                stats["norm"] = norm
+            # same as optimizer.step() if disabled
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            self.optimizer.zero_grad(set_to_none=True)
             stats["rate"] = self.optimizer.param_groups[0]["lr"]
             self.reporter.update(egs, ["#utt", "#tok"])
             self.reporter.update(stats)
@@ -164,6 +207,14 @@ class DdpTrainer(Trainer):
             self.lr_scheduler_step(None, end_at="step")
             return True
         else:
+            # drop the invalid gradients (and decrease the loss scale)
+            scale = self.scaler.get_scale()
+            self.scaler.update()
+            self.optimizer.zero_grad(set_to_none=True)
+            # fp16 overflow: the scaler backs off and skips the step, which
+            # is expected and not an error (get_scale() is 1.0 if disabled)
+            if self.scaler.get_scale() < scale:
+                return True
             self.reporter.log(f"Invalid gradient {norm:.3f}, skip...")
             return False
 
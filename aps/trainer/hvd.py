@@ -147,7 +147,7 @@ class HvdTrainer(Trainer):
         if self.clip_gradient > 0:
             # for horovod
             self.optimizer.synchronize()
-            norm = clip_grad_norm_(self.task.parameters(), self.clip_gradient)
+            norm = clip_grad_norm_(self.params, self.clip_gradient)
 
         # step optimizer and update statistics
         if math.isfinite(norm):
@@ -40,12 +40,15 @@ def check_valid(feature: th.Tensor,
         num_frames: N or None
     """
     num_nans = th.sum(th.isnan(feature))
+    if num_frames is not None:
+        # copy both numbers to host at once (one device sync)
+        num_nans, max_frames = th.stack(
+            [num_nans, num_frames.max().to(num_nans)]).tolist()
     shape = feature.shape
     if num_nans:
         raise ValueError(f"Detect {num_nans} NANs in feature matrices, " +
                          f"shape = {shape}...")
     if num_frames is not None:
-        max_frames = num_frames.max().item()
         if feature.shape[-2] < max_frames:
             raise RuntimeError(f"feats shape: {shape[-2]} x {shape[-1]}, " +
                                f"num_frames = {num_frames.tolist()}")
@@ -168,21 +171,23 @@ class SpeedPerturbTransform(nn.Module):
             raise RuntimeError(f"Now only supports 2D tensor, got {wav.dim()}")
         choice = th.randint(0, len(self.weights) + 1, (wav.shape[0],))
         self.last_choice = choice
+        choice = choice.tolist()
         wav_sp = []
-        # each utterance is different
-        # NOTE: make it same in previous commits
-        for i, c in enumerate(self.last_choice.tolist()):
+        # each utterance is different, but the ones sharing the same factor
+        # are perturbed together (rows are independent in perturb_speed)
+        for c in set(choice):
+            index = [i for i, n in enumerate(choice) if n == c]
             # 1.0, do not apply speed perturb
             if c == len(self.weights):
-                wav_sp.append(wav[i])
+                wav_sp.append((index, wav[index]))
             else:
-                wav_sp.append(perturb_speed(wav[i:i + 1], self.weights[c])[0])
+                wav_sp.append(
+                    (index, perturb_speed(wav[index], self.weights[c])))
         # may produce longer utterance
-        wav_sp_pad = th.zeros(
-            [wav.shape[0], max([w.shape[-1] for w in wav_sp])],
-            device=wav.device)
-        for i, w in enumerate(wav_sp):
-            wav_sp_pad[i, :w.shape[-1]] = w
+        wav_sp_pad = wav.new_zeros(
+            [wav.shape[0], max([w.shape[-1] for _, w in wav_sp])])
+        for index, w in wav_sp:
+            wav_sp_pad[index, :w.shape[-1]] = w
         return wav_sp_pad
 
 
@@ -670,6 +675,24 @@ class DeltaTransform(nn.Module):
     def dim_scale(self) -> int:
         return self.order
 
+    def _delta(self, feats: th.Tensor) -> th.Tensor:
+        """
+        Compute the delta as a 1D convolution along the time axis (edge frames
+        are repeated, same as splice_feature), instead of splicing the context
+        frames out and reducing them
+        Args:
+            feats (Tensor): N x (C) x T x F
+        Return:
+            delta (Tensor): N x (C) x T x F
+        """
+        T, F = feats.shape[-2:]
+        # N(C)F x 1 x T
+        x = feats.transpose(-1, -2).reshape(-1, 1, T)
+        x = tf.pad(x, (self.ctx, self.ctx), mode="replicate")
+        x = tf.conv1d(x, self.scale[None, None])
+        # N x (C) x T x F
+        return x.view(feats.shape[:-2] + (F, T)).transpose(-1, -2)
+
     def forward(self, feats: th.Tensor) -> th.Tensor:
         """
         args:
@@ -679,13 +702,7 @@ class DeltaTransform(nn.Module):
         """
         delta = [feats]
         for _ in range(self.order):
-            # N x T x F x (2C+1)
-            splice = splice_feature(delta[-1],
-                                    lctx=self.ctx,
-                                    rctx=self.ctx,
-                                    op="stack")
-            # N x T x F
-            delta.append(th.sum(splice * self.scale, -1))
+            delta.append(self._delta(delta[-1]))
         if self.delta_as_channel:
             # N x C x T x F
             return th.stack(delta, 1)
@@ -225,12 +225,16 @@ class DfTransform(nn.Module):
             # on channel dimention (mean or sum)
             af = th.mean(af, dim=1)
         else:
-            # N x D x C x F x 1
-            dif = d[:, :, self.index_l] - d[:, :, self.index_r]
-            # N x D x C x F x T
-            af = th.cos(ipd.unsqueeze(1) - dif)
+            # N x D x C x F
+            dif = (d[:, :, self.index_l] - d[:, :, self.index_r]).squeeze(-1)
+            # cos(a - b) = cos(a)cos(b) + sin(a)sin(b), so the trigonometric
+            # functions on ipd are computed once instead of D times and the
+            # channel mean becomes a contraction (no N x D x C x F x T tensor)
             # N x D x F x T
-            af = th.mean(af, dim=2)
+            eq = "ncft,ndcf->ndft"
+            af = th.einsum(eq, th.cos(ipd), th.cos(dif)) + th.einsum(
+                eq, th.sin(ipd), th.sin(dif))
+            af = af / len(self.index_l)
         return af
 
     def forward(self, p: th.Tensor, doa: Union[th.Tensor,
@@ -330,16 +334,19 @@ class FixedBeamformer(nn.Module):
         if self.real.shape[1] != r.shape[1]:
             raise RuntimeError(f"Number of channels mismatch: "
                                f"{r.shape[1]} vs {self.real.shape[1]}")
+        # B x C x F
+        wr, wi = self.real[..., 0], self.imag[..., 0]
         if beam is None:
             # output all the beam
-            br = th.sum(r.unsqueeze(1) * self.real, 2) + th.sum(
-                i.unsqueeze(1) * self.imag, 2)
-            bi = th.sum(i.unsqueeze(1) * self.real, 2) - th.sum(
-                r.unsqueeze(1) * self.imag, 2)
+            eq = "ncft,bcf->nbft"
         else:
-            # output selected beam
-            br = th.sum(r * self.real[beam], 1) + th.sum(i * self.imag[beam], 1)
-            bi = th.sum(i * self.real[beam], 1) - th.sum(r * self.imag[beam], 1)
+            # output selected beam, N x C x F
+            wr, wi = wr[beam], wi[beam]
+            eq = "ncft,ncf->nft"
+        # contract the channel axis with GEMMs instead of broadcasting to
+        # N x B x C x F x T and reducing
+        br = th.einsum(eq, r, wr) + th.einsum(eq, i, wi)
+        bi = th.einsum(eq, i, wr) - th.einsum(eq, r, wi)
         if squeeze:
             br = br.squeeze()
             bi = bi.squeeze()
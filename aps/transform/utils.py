@@ -2,6 +2,7 @@
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
 import math
+import functools
 
 import numpy as np
 import torch as th
@@ -10,7 +11,7 @@ import torch.nn.functional as tf
 import librosa.filters as filters
 
 from aps.const import EPSILON, TORCH_VERSION
-from typing import Optional
+from typing import Optional, Tuple
 
 if TORCH_VERSION >= 1.7:
     from torch.fft import fft as fft_func
@@ -100,6 +101,28 @@ def init_kernel(frame_len: int,
     return K.to(window.device), window
 
 
+@functools.lru_cache(maxsize=16)
+def _cached_kernel(frame_len: int, frame_hop: int, window: str,
+                   round_pow_of_two: bool, normalized: bool, inverse: bool,
+                   mode: str, device: th.device) -> Tuple[th.Tensor]:
+    """
+    Return the window (and STFT kernels if mode != "torch") used by the
+    functional forward_stft/inverse_stft, cached as the settings are fixed
+    for a given transform. The returned tensors are shared, don't modify
+    them in-place
+    """
+    wnd = init_window(window, frame_len, device=device)
+    if mode == "torch":
+        return None, wnd
+    return init_kernel(frame_len,
+                       frame_hop,
+                       wnd,
+                       round_pow_of_two=round_pow_of_two,
+                       normalized=normalized,
+                       inverse=inverse,
+                       mode=mode)
+
+
 def mel_filter(frame_len: int,
                round_pow_of_two: bool = True,
                num_bins: Optional[int] = None,
@@ -371,7 +394,7 @@ def _pytorch_stft(wav: th.Tensor,
     # if N x C x S, reshape NC x S
     N, S = wav.shape[0], wav.shape[-1]
     wav = wav.view(-1, S)
-    # STFT: N x F x T x 2
+    # STFT: N x F x T (complex)
     stft = th.stft(wav,
                    n_fft,
                    hop_length=frame_hop,
@@ -380,7 +403,9 @@ def _pytorch_stft(wav: th.Tensor,
                    center=center,
                    normalized=normalized,
                    onesided=onesided,
-                   return_complex=False)
+                   return_complex=True)
+    # N x F x T x 2, a view without copy
+    stft = th.view_as_real(stft)
     if wav_dim == 3:
         stft = stft.view(N, -1, stft.shape[-3], stft.shape[-2])
     # N x (C) x F x T x 2
@@ -475,7 +500,9 @@ def forward_stft(wav: th.Tensor,
     Return:
         transform: results of STFT
     """
-    window = init_window(window, frame_len, device=wav.device)
+    kernel, window = _cached_kernel(frame_len, frame_hop, window,
+                                    round_pow_of_two, normalized, False, mode,
+                                    wav.device)
     if mode == "torch":
         n_fft = 2**math.ceil(
             math.log2(frame_len)) if round_pow_of_two else frame_len
@@ -489,13 +516,6 @@ def forward_stft(wav: th.Tensor,
                              onesided=onesided,
                              center=center)
     else:
-        kernel, _ = init_kernel(frame_len,
-                                frame_hop,
-                                window=window,
-                                round_pow_of_two=round_pow_of_two,
-                                normalized=normalized,
-                                inverse=False,
-                                mode=mode)
         return _forward_stft(wav,
                              kernel,
                              return_polar=return_polar,
@@ -531,7 +551,9 @@ def inverse_stft(transform: th.Tensor,
     Return:
         wav: synthetic signals
     """
-    window = init_window(window, frame_len, device=transform.device)
+    kernel, window = _cached_kernel(frame_len, frame_hop, window,
+                                    round_pow_of_two, normalized, True, mode,
+                                    transform.device)
     if mode == "torch":
         n_fft = 2**math.ceil(
             math.log2(frame_len)) if round_pow_of_two else frame_len
@@ -545,13 +567,6 @@ def inverse_stft(transform: th.Tensor,
                               onesided=onesided,
                               center=center)
     else:
-        kernel, window = init_kernel(frame_len,
-                                     frame_hop,
-                                     window,
-                                     round_pow_of_two=round_pow_of_two,
-                                     normalized=normalized,
-                                     inverse=True,
-                                     mode=mode)
         return _inverse_stft(transform,
                              kernel,
                              window,
@@ -8,6 +8,7 @@ import time
 import random
 import codecs
 import logging
+import logging.handlers
 
 import torch as th
 import numpy as np
@@ -22,13 +23,17 @@ time_format = "%Y-%m-%d %H:%M:%S"
 
 def get_logger(name: str,
                date_format: str = time_format,
-               file: bool = False) -> logging.Logger:
+               file: bool = False,
+               buffer_size: int = 0) -> logging.Logger:
     """
     Get logger instance
     Args:
         name: logger name
         format_str|date_format: to configure logging format
         file: if true, treat name as the name of the logging file
+        buffer_size: if > 0, buffer the records (write to the logging file
+                     when #buffer_size records are cached, warnings come or
+                     the handlers are flushed)
     """
 
     def get_handler(handler, format_str):
@@ -46,6 +51,11 @@ def get_logger(name: str,
     if file:
         output_handler = get_handler(logging.FileHandler(name),
                                      common_logger_format)
+        if buffer_size > 0:
+            output_handler = logging.handlers.MemoryHandler(
+                buffer_size,
+                flushLevel=logging.WARNING,
+                target=output_handler)
         logger.addHandler(output_handler)
     return logger
 
@@ -71,21 +81,31 @@ def io_wrapper(io_str: str, mode: str) -> Tuple[bool, Any]:
     return std, stream
 
 
-def load_obj(obj: Any, device: Union[th.device, str]) -> Any:
+def load_obj(obj: Any,
+             device: Union[th.device, str],
+             non_blocking: bool = False) -> Any:
     """
     Offload tensor object in obj to cuda device
     Args:
         obj: Arbitrary object
         device: target device ("cpu", "cuda" or th.device object)
+        non_blocking: asynchronous copy (only if the tensors are in the
+                      pinned memory, otherwise it's same as the normal one)
     """
 
     def cuda(obj):
-        return obj.to(device) if isinstance(obj, th.Tensor) else obj
+        return obj.to(device, non_blocking=non_blocking) if isinstance(
+            obj, th.Tensor) else obj
 
     if isinstance(obj, dict):
-        return {key: load_obj(obj[key], device) for key in obj}
+        return {
+            key: load_obj(obj[key], device, non_blocking=non_blocking)
+            for key in obj
+        }
     elif isinstance(obj, list):
-        return [load_obj(val, device) for val in obj]
+        return [
+            load_obj(val, device, non_blocking=non_blocking) for val in obj
+        ]
     else:
         return cuda(obj)
 
@@ -42,6 +42,10 @@ class CtcAligner(NnetEvaluator):
                                          device_id=device_id)
         logger.info(f"Load the checkpoint from {cpt_dir}, epoch: " +
                     f"{self.epoch}, tag: {cpt_tag}")
+        # fuse encoder output layer & CTC layer if possible
+        fuse = getattr(self.nnet, "prepare_for_inference", None)
+        if fuse is not None and fuse():
+            logger.info("Fuse the output layer of the encoder with CTC")
 
     def run(self, inp: np.ndarray, seq: np.ndarray) -> Dict:
         inp = th.from_numpy(inp).to(self.device)
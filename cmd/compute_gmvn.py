@@ -3,20 +3,19 @@
 # Copyright 2019 Jian Wu
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
-import yaml
 import argparse
 
 import torch as th
 
 from aps.loader import AudioReader
 from aps.libs import aps_transform
+from aps.conf import load_yaml
 
 removed_keys = ["cmvn", "splice", "aug", "delta", "perturb"]
 
 
 def run(args):
-    with open(args.conf, "r") as f:
-        conf = yaml.full_load(f)
+    conf = load_yaml(args.conf)
     trans_key = f"{args.transform}_transform"
     if trans_key not in conf:
         print(f"No {trans_key} in {args.conf}, exist ...")
@@ -6,8 +6,11 @@
 import pytest
 import torch as th
 
+import aps.distributed as dist
+
 from aps.libs import aps_dataloader
 from aps.conf import load_dict
+from aps.loader.am.utils import derive_indices, num_rank_batches
 
 
 @pytest.mark.parametrize("batch_size", [1, 2, 4])
@@ -153,3 +156,28 @@ def test_lm_bptt_loader(batch_size, obj):
     for egs in loader:
         assert egs["src"].shape == egs["tgt"].shape
         assert egs["src"].shape == th.Size([batch_size, 10])
+
+
+@pytest.mark.parametrize("num_batches", [9, 10, 12])
+@pytest.mark.parametrize("drop_last", [True, False])
+def test_derive_indices(monkeypatch, num_batches, drop_last):
+    world_size = 4
+    monkeypatch.setattr(dist, "world_size", lambda: world_size)
+    indices = []
+    for rank in range(world_size):
+        monkeypatch.setattr(dist, "rank", lambda: rank)
+        subset = derive_indices(num_batches,
+                                seed=0,
+                                shuffle=True,
+                                distributed=True,
+                                drop_last=drop_last)
+        assert len(subset) == num_rank_batches(num_batches,
+                                               distributed=True,
+                                               drop_last=drop_last)
+        indices += subset
+    # no overlap between the ranks
+    assert len(indices) == len(set(indices))
+    if drop_last:
+        assert len(indices) == num_batches // world_size * world_size
+    else:
+        assert sorted(indices) == list(range(num_batches))
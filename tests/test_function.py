@@ -3,15 +3,20 @@
 # Copyright 2020 Jian Wu
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
+import io
 import pytest
 import torch as th
 import torch.nn as nn
+import torch.nn.functional as tf
 
-from aps.libs import dynamic_importlib, ApsRegisters, ApsModules
+from aps.libs import dynamic_importlib, ApsRegisters, ApsModules, aps_asr_nnet
 from aps.conf import load_dict
 from aps.asr.xfmr.impl import ApsMultiheadAttention
-from aps.asr.xfmr.utils import digit_shift, prep_sub_mask
+from aps.asr.xfmr.decoder import TorchTransformerDecoder
+from aps.asr.xfmr.utils import digit_shift, prep_sub_mask, batched_dot_att
 from aps.asr.base.attention import padding_mask
+from aps.asr.base.layer import VariantRNN, FSMN, var_len_rnn_forward
+from aps.trainer.base import ParameterAverager, ProgressReporter
 
 
 @pytest.mark.parametrize(
@@ -62,6 +67,18 @@ def test_rel_pose(N, H, T, D, K):
     th.testing.assert_allclose(ans1, ans2)
 
 
+@pytest.mark.parametrize("L, S, N, H, D", [
+    pytest.param(32, 32, 2, 4, 64),
+    pytest.param(31, 20, 1, 8, 32)
+])
+def test_batched_dot_att(L, S, N, H, D):
+    query = th.rand(L, N, H, D)
+    key = th.rand(S, N, H, D)
+    bias = th.rand(L, N, H, S)
+    ref = th.einsum("lnhd,snhd->lnhs", query, key) + bias
+    th.testing.assert_allclose(batched_dot_att(query, key, bias), ref)
+
+
 @pytest.mark.parametrize("index", [0, 1, 2])
 def test_aps_selfattn(index):
     S, L, N, E = 100, 100, 8, 256
@@ -97,3 +114,213 @@ def test_aps_selfattn(index):
     assert my2.shape == th2.shape
     th.testing.assert_allclose(my2, th2)
     th.testing.assert_allclose(my1, th1)
+
+
+@pytest.mark.skipif(not hasattr(tf, "scaled_dot_product_attention"),
+                    reason="scaled_dot_product_attention is not available")
+@pytest.mark.parametrize("causal", [True, False])
+def test_aps_sdpa(causal):
+    S, N, E = 100, 8, 256
+    self_attn = ApsMultiheadAttention(E, 4, dropout=0, use_sdpa=True)
+    self_attn.eval()
+    query = th.rand(S, N, E)
+    key_len = th.randint(S // 2, S, (N,))
+    key_len[0] = S
+    key_padding_mask = padding_mask(key_len)
+    attn_mask = prep_sub_mask(S) if causal else None
+    my1 = self_attn(query,
+                    query,
+                    query,
+                    None,
+                    key_padding_mask=key_padding_mask,
+                    attn_mask=attn_mask)[0]
+    th1 = self_attn.torch_forward(query,
+                                  query,
+                                  query,
+                                  key_padding_mask=key_padding_mask,
+                                  attn_mask=attn_mask)[0]
+    th.testing.assert_allclose(my1, th1)
+
+
+@pytest.mark.parametrize("bias", [True, False])
+def test_aps_mhsa_step(bias):
+    L, N, E = 10, 4, 64
+    aps_mhsa = ApsMultiheadAttention(E,
+                                     4,
+                                     dropout=0,
+                                     bias=bias,
+                                     use_torch=False)
+    aps_mhsa.eval()
+    query = th.rand(L, N, E)
+    attn_mask = prep_sub_mask(L)
+    ans1 = aps_mhsa(query, query, query, attn_mask=attn_mask)[0]
+    # step by step with key/value cache
+    ans2, kv_cache = [], None
+    for t in range(L):
+        out, kv_cache = aps_mhsa.step(query[t:t + 1],
+                                      kv_cache=kv_cache,
+                                      attn_mask=attn_mask[t:t + 1, :t + 1])
+        ans2.append(out)
+    th.testing.assert_allclose(ans1, th.cat(ans2, 0))
+
+
+@pytest.mark.parametrize("pre_norm", [True, False])
+def test_xfmr_lm_step(pre_norm):
+    N, T, V = 4, 10, 100
+    xfmr_lm = aps_asr_nnet("asr@xfmr_lm")(vocab_size=V,
+                                          num_layers=2,
+                                          arch_kwargs={
+                                              "att_dim": 128,
+                                              "nhead": 4,
+                                              "feedforward_dim": 256,
+                                              "att_dropout": 0,
+                                              "ffn_dropout": 0,
+                                              "pre_norm": pre_norm
+                                          })
+    xfmr_lm.eval()
+    token = th.randint(0, V, (N, T))
+    # full forward
+    ans1, _ = xfmr_lm(token, None)
+    # step by step with key/value cache
+    ans2, kv_cache = [], None
+    for t in range(T):
+        out, kv_cache = xfmr_lm.step(token[:, t:t + 1], kv_cache)
+        ans2.append(out)
+    ans2 = th.cat(ans2, 1)
+    th.testing.assert_allclose(ans1, ans2)
+
+
+@pytest.mark.parametrize("pre_norm", [True, False])
+def test_xfmr_decoder_memory_cache(pre_norm):
+    N, T, U, V, D = 4, 20, 5, 100, 128
+    decoder = TorchTransformerDecoder(V,
+                                      num_layers=2,
+                                      arch_kwargs={
+                                          "att_dim": D,
+                                          "nhead": 4,
+                                          "feedforward_dim": 256,
+                                          "pre_norm": pre_norm
+                                      })
+    decoder.eval()
+    enc_out = th.rand(T, N, D)
+    enc_len = th.randint(T // 2, T + 1, (N,))
+    enc_len[0] = T
+    tgt_pad = th.randint(0, V, (N, U))
+    ans1, _ = decoder.step(enc_out, tgt_pad, enc_len=enc_len)
+    ans2, _ = decoder.step(enc_out,
+                           tgt_pad,
+                           enc_len=enc_len,
+                           memory_kv=decoder.memory_cache(enc_out))
+    th.testing.assert_allclose(ans1, ans2)
+
+
+@pytest.mark.parametrize("autocast", [False, True])
+@pytest.mark.parametrize("bidirectional", [False, True])
+def test_var_len_rnn_forward(autocast, bidirectional):
+    rnn = VariantRNN(80,
+                     hidden_size=64,
+                     rnn="lstm",
+                     project=64,
+                     bidirectional=bidirectional,
+                     autocast=autocast)
+    rnn.eval()
+    # unsorted lengths
+    inp_len = th.tensor([30, 50, 20, 40])
+    inp = th.rand(4, 50, 80)
+    with th.no_grad():
+        out = rnn(inp, inp_len)
+        for n, T in enumerate(inp_len.tolist()):
+            ref = rnn(inp[n:n + 1, :T], None)
+            th.testing.assert_allclose(out[n, :T], ref[0])
+
+
+@pytest.mark.parametrize("add_forward_backward", [False, True])
+def test_var_len_rnn_forward_order(add_forward_backward):
+    rnn = nn.GRU(40, 32, batch_first=True, bidirectional=True)
+    rnn.eval()
+    inp_len = th.tensor([12, 30, 7, 30, 21])
+    inp = th.rand(5, 30, 40)
+    with th.no_grad():
+        out = var_len_rnn_forward(rnn,
+                                  inp,
+                                  inp_len=inp_len,
+                                  add_forward_backward=add_forward_backward)
+        for n, T in enumerate(inp_len.tolist()):
+            ref = var_len_rnn_forward(
+                rnn,
+                inp[n:n + 1, :T],
+                add_forward_backward=add_forward_backward)
+            th.testing.assert_allclose(out[n, :T], ref[0])
+            # padding frames are zero
+            assert th.sum(out[n, T:].abs()) == 0
+
+
+def test_fsmn_state_dict_average():
+    egs = th.rand(2, 20, 40)
+    states = []
+    for _ in range(2):
+        fsmn = FSMN(40, 64, 32, lctx=3, rctx=3, norm="", dilation=1)
+        buf = io.BytesIO()
+        th.save(fsmn.state_dict(), buf)
+        buf.seek(0)
+        states.append(th.load(buf))
+    averager = ParameterAverager()
+    for state in states:
+        averager.add(state)
+    buf = io.BytesIO()
+    th.save(averager.state_dict(), buf)
+    buf.seek(0)
+    fsmn = FSMN(40, 64, 32, lctx=3, rctx=3, norm="", dilation=1)
+    fsmn.load_state_dict(th.load(buf))
+    fsmn.eval()
+    for key, value in fsmn.state_dict().items():
+        avg = (states[0][key] + states[1][key]) / 2
+        th.testing.assert_allclose(value, avg)
+    # plain dict (no _metadata) is taken as the current layout
+    ref = FSMN(40, 64, 32, lctx=3, rctx=3, norm="", dilation=1)
+    ref.load_state_dict(dict(fsmn.state_dict()))
+    ref.eval()
+    th.testing.assert_allclose(ref(egs)[0], fsmn(egs)[0])
+    # version 1 checkpoints still get the identity folded in
+    state = fsmn.state_dict()
+    state._metadata[""]["version"] = 1
+    ref.load_state_dict(state)
+    ctx_diff = ref.ctx_conv[1].weight - fsmn.ctx_conv[1].weight
+    assert th.allclose(ctx_diff[..., 3], th.ones_like(ctx_diff[..., 3]))
+    # version 2 checkpoints use a linear layer (2D weight) for inp_proj
+    state = fsmn.state_dict()
+    state._metadata[""]["version"] = 2
+    state["inp_proj.weight"] = state["inp_proj.weight"][..., 0]
+    ref.load_state_dict(state)
+    th.testing.assert_allclose(ref(egs)[0], fsmn(egs)[0])
+
+
+def test_reporter_all_reduce(tmp_path):
+    import torch.distributed as torch_dist
+    import aps.distributed.backend as backend
+    torch_dist.init_process_group("gloo",
+                                  init_method=f"file://{tmp_path}/init",
+                                  rank=0,
+                                  world_size=1)
+    backend.BACKEND = "torch"
+    try:
+        reporter = ProgressReporter(tmp_path, ["loss", "accu"],
+                                    rank=0,
+                                    tensorboard=False,
+                                    reduction_tag="#tok")
+        reporter.eval()
+        for num_tok, loss, accu in [(10, 2.0, 0.5), (30, 1.0, 0.8)]:
+            reporter.update({"#tok": num_tok}, ["#tok"])
+            reporter.update({"loss": th.tensor(loss), "accu": accu})
+        reports = reporter._report_metrics()
+        reporter.all_reduce(th.device("cpu"))
+        assert reporter.count["loss"] == 2
+        for key, value in reporter._report_metrics().items():
+            assert value == pytest.approx(reports[key])
+        # rank without any validation batch
+        reporter.reset()
+        reporter.all_reduce(th.device("cpu"))
+        assert "loss" not in reporter.count
+    finally:
+        backend.BACKEND = "none"
+        torch_dist.destroy_process_group()
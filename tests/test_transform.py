@@ -8,11 +8,11 @@ import pytest
 import librosa
 import torch as th
 
-from aps.transform.utils import forward_stft, inverse_stft
+from aps.transform.utils import forward_stft, inverse_stft, splice_feature
 from aps.cplx import ComplexTensor
 from aps.loader import read_audio
 from aps.transform import AsrTransform, EnhTransform, FixedBeamformer, DfTransform
-from aps.transform.asr import SpeedPerturbTransform
+from aps.transform.asr import SpeedPerturbTransform, DeltaTransform
 
 egs1_wav = read_audio("data/transform/egs1.wav", sr=16000)
 egs2_wav = read_audio("data/transform/egs2.wav", sr=16000)
@@ -110,6 +110,23 @@ def test_speed_perturb(max_length):
         assert wav_out.shape[-1] == out_len.item()
 
 
+@pytest.mark.parametrize("batch_size", [8])
+@pytest.mark.parametrize("max_length", [160000])
+def test_batch_speed_perturb(batch_size, max_length):
+    speed_perturb = SpeedPerturbTransform(sr=16000)
+    wav_len = th.randint(max_length // 2, max_length, (batch_size,))
+    wav_len[0] = max_length
+    wav = th.randn(batch_size, max_length)
+    for n, s in enumerate(wav_len.tolist()):
+        wav[n, s:] = 0
+    wav_out = speed_perturb(wav)
+    out_len = speed_perturb.output_length(wav_len)
+    pad_len = speed_perturb.output_length(th.full_like(wav_len, max_length))
+    assert wav_out.shape[0] == batch_size
+    assert wav_out.shape[-1] == pad_len.max().item()
+    assert th.all(out_len <= wav_out.shape[-1])
+
+
 @pytest.mark.parametrize("wav", [egs2_wav])
 @pytest.mark.parametrize("feats,shape",
                          [("spectrogram-log-cmvn-aug-ipd", [1, 366, 257 * 5]),
@@ -162,6 +179,17 @@ def test_df_transform(num_bins, num_doas):
         assert df.shape == th.Size([batch_size, num_doas, num_bins, num_frames])
 
 
+@pytest.mark.parametrize("ctx", [1, 2])
+@pytest.mark.parametrize("shape", [(2, 50, 40), (2, 3, 50, 40)])
+def test_delta_transform(ctx, shape):
+    delta = DeltaTransform(ctx=ctx, order=1)
+    feats = th.rand(*shape)
+    splice = splice_feature(feats, lctx=ctx, rctx=ctx, op="stack")
+    ref = th.sum(splice * delta.scale, -1)
+    out = delta(feats)[..., shape[-1]:]
+    th.testing.assert_allclose(out, ref)
+
+
 def debug_visualize_feature():
     transform = AsrTransform(feats="fbank-log-cmvn-delta",
                              frame_len=400,